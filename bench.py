@@ -0,0 +1,953 @@
+"""Бенчмарки LegalBot.
+
+Запуск: python bench.py <сценарий> [параметры]
+Каждый сценарий работает с временной базой и не трогает bot.db.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+
+def setup_env(tmpdir: str):
+    # Изолированная база для прогона; BOT_TOKEN берется из .env
+    os.environ['DATABASE_PATH'] = os.path.join(tmpdir, 'bench.db')
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def report(name: str, result: dict, args=None):
+    # С --output результат сохраняется в JSON для сравнения прогонов между ревизиями
+    payload = {"scenario": name, **result}
+    text = json.dumps(payload, ensure_ascii=False, indent=2)
+    print(text)
+    if args is not None and args.output:
+        payload = {"revision": git_revision(), "timestamp": int(time.time()), **payload}
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
+
+
+# ===== DB: соединения на запрос =====
+def bench_db(args):
+    import aiosqlite
+    from fastapi.testclient import TestClient
+
+    connects = 0
+    original_connect = aiosqlite.connect
+
+    def counting_connect(*a, **kw):
+        nonlocal connects
+        connects += 1
+        return original_connect(*a, **kw)
+
+    aiosqlite.connect = counting_connect
+    import legalbot
+
+    with TestClient(legalbot.app) as client:
+        asyncio.run(seed_requests(legalbot.DB_PATH, args.rows))
+        client.post('/admin/login', data={'username': 'admin', 'password': '1234'})
+
+        before = connects
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            response = client.get('/admin/api/requests', params={'limit': 50})
+            response.raise_for_status()
+        elapsed = time.perf_counter() - started
+
+    report("db", {
+        "requests": args.requests,
+        "rows": args.rows,
+        "connects_per_request": (connects - before) / args.requests,
+        "pool_connects": legalbot.db.connects,
+        "avg_ms": round(elapsed / args.requests * 1000, 3),
+    }, args)
+
+
+async def seed_requests(path: str, rows: int):
+    import aiosqlite
+
+    async with aiosqlite.connect(path) as conn:
+        await conn.executemany(
+            "INSERT INTO requests (user_id, name, phone, message, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(i, f"Client {i}", "+70000000000", "Описание проблемы " * 5,
+              f"2024-01-01T00:00:{i % 60:02d}.{i:06d}+00:00") for i in range(rows)]
+        )
+        await conn.commit()
+
+
+# ===== Запись заявки: 0/10/50 документов =====
+async def insert_loop(conn, record: dict):
+    # Прежний путь finish_handler: отдельный INSERT и datetime.now() на каждый документ.
+    # Остальное как в save_request (идемпотентность, RETURNING, событие админки),
+    # чтобы сравнение показывало только разницу в записи документов
+    from datetime import datetime, timezone
+    import legalbot
+
+    cursor = await conn.execute(
+        """INSERT INTO requests (user_id, name, phone, message, created_at, source_message_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, source_message_id) DO NOTHING
+        RETURNING id""",
+        (record["user_id"], record["name"], record["phone"], record["message"],
+         datetime.now(timezone.utc).isoformat(), record["source_message_id"])
+    )
+    row = await cursor.fetchone()
+    await cursor.close()
+    request_id = row[0]
+    for doc in record["docs"]:
+        await conn.execute(
+            """INSERT INTO documents (request_id, file_id, file_name, file_type, file_size, sent_at)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (request_id, doc['file_id'], doc['file_name'], doc['file_type'],
+             doc['file_size'], datetime.now(timezone.utc).isoformat())
+        )
+    await legalbot.publish_event(conn, "request_created", request_id, {
+        "id": request_id,
+        "user_id": record["user_id"],
+        "name": record["name"],
+        "phone": record["phone"],
+        "message": legalbot.shorten_message(record["message"]),
+        "created_at": record["created_at"],
+        "status": "new",
+        "documents": [{"request_id": request_id, **doc} for doc in record["docs"]]
+    })
+
+
+def bench_insert(args):
+    import legalbot
+
+    async def run() -> list:
+        await legalbot.db.open()
+        await legalbot.init_db()
+        results = []
+        for docs_count in (0, 10, 50):
+            data = {
+                'name': 'Client', 'phone': '+70000000000', 'message_text': 'Описание проблемы',
+                'docs': [{'file_id': f'F{i}', 'file_name': f'doc{i}.pdf', 'file_type': 'application/pdf',
+                          'file_size': 1024} for i in range(docs_count)],
+            }
+            timings = {}
+            for name in ("loop", "executemany"):
+                started = time.perf_counter()
+                for i in range(args.requests):
+                    record = legalbot.build_request_record(i, data, hash((name, docs_count, i)))
+                    async with legalbot.db.write() as conn:
+                        if name == "loop":
+                            await insert_loop(conn, record)
+                        else:
+                            await legalbot.save_request(conn, record)
+                timings[name] = round((time.perf_counter() - started) / args.requests * 1000, 3)
+            results.append({"documents": docs_count, "ms_per_request": timings})
+        await legalbot.db.close()
+        return results
+
+    report("insert", {"requests": args.requests, "runs": asyncio.run(run())}, args)
+
+
+# ===== Поддельный Telegram Bot API =====
+ADMIN_CHAT_ID = '-1001'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeBotAPI:
+    """Локальный сервер Bot API в отдельном процессе вместо Telegram.
+
+    Счетчики вызовов доступны по GET /_stats и сбрасываются POST /_reset.
+    """
+
+    def __init__(self, file_size: int = 100 * 1024):
+        self.file_size = file_size
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.proc: subprocess.Popen = None
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'fake-api', '--port', str(self.port),
+             '--file-size', str(self.file_size)]
+        )
+        wait_ready(self.url, path='/_stats')
+
+    def stop(self):
+        if self.proc:
+            self.proc.terminate()
+            self.proc.wait()
+
+    def calls(self) -> Counter:
+        import httpx
+
+        return Counter(httpx.get(f"{self.url}/_stats").json())
+
+    def reset(self):
+        import httpx
+
+        httpx.post(f"{self.url}/_reset")
+
+
+def serve_fake_api(args):
+    from aiohttp import web
+
+    calls = Counter()
+    message_ids = iter(range(1, sys.maxsize))
+
+    def message(data) -> dict:
+        return {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(data.get('chat_id', 0)), "type": "private"},
+            "text": data.get('text', ''),
+        }
+
+    def result(method: str, data) -> object:
+        if method in ('sendMessage', 'sendDocument'):
+            return message(data)
+        if method == 'sendMediaGroup':
+            return [message(data) for _ in json.loads(data['media'])]
+        if method == 'getMe':
+            return {"id": 1, "is_bot": True, "first_name": "LegalBot", "username": "legalbot"}
+        if method == 'getWebhookInfo':
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method == 'getFile':
+            file_id = data.get('file_id', '')
+            return {"file_id": file_id, "file_unique_id": f"U{file_id}", "file_path": f"documents/{file_id}.pdf"}
+        return True
+
+    async def handle(request):
+        method = request.match_info['method']
+        calls[method] += 1
+        data = await request.post()
+        # Отрицательный chat_id — чат администраторов; такие вызовы считаются отдельно
+        if str(data.get('chat_id', '')).startswith('-'):
+            calls[f'admin:{method}'] += 1
+        return web.json_response({"ok": True, "result": result(method, data)})
+
+    async def download(request):
+        # Содержимое зависит только от имени файла: одинаковые file_id дают одинаковые байты
+        calls['download'] += 1
+        seed = request.match_info['path'].encode()
+        return web.Response(body=(seed * (args.file_size // len(seed) + 1))[:args.file_size])
+
+    async def stats(request):
+        return web.json_response(calls)
+
+    async def reset(request):
+        calls.clear()
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handle)
+    app.router.add_get('/file/bot{token}/{path:.+}', download)
+    app.router.add_get('/_stats', stats)
+    app.router.add_post('/_reset', reset)
+    web.run_app(app, host='127.0.0.1', port=args.port, print=None, access_log=None)
+
+
+def app_env(api: FakeBotAPI, tmpdir: str, **extra) -> dict:
+    env = dict(os.environ)
+    env.update({
+        'TELEGRAM_API_URL': api.url,
+        'STORAGE_DIR': os.path.join(tmpdir, 'storage'),
+        'DATABASE_PATH': os.path.join(tmpdir, 'bench.db'),
+        'DOWNLOAD_CACHE_DIR': os.path.join(tmpdir, 'cache'),
+        'FSM_STORAGE': 'sqlite',
+        'SESSION_SECRET': 'bench',
+        'ADMIN_CHAT_ID': ADMIN_CHAT_ID,
+        # Сценарии гонят сотни обновлений от одного чата: защита от флуда их бы отбросила
+        'THROTTLE_RATE': '0',
+        # Заголовок секрета шлет только сценарий parse
+        'WEBHOOK_SECRET': '',
+    })
+    env.update({key: str(value) for key, value in extra.items()})
+    return env
+
+
+def start_server(env: dict, workers: int) -> tuple:
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'legalbot:app', '--host', '127.0.0.1',
+         '--port', str(port), '--workers', str(workers), '--log-level', 'warning'],
+        env={**env, 'WEB_CONCURRENCY': str(workers)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    wait_ready(base_url)
+    return proc, base_url
+
+
+def wait_ready(base_url: str, path: str = '/webhook/stats', timeout: float = 30.0):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{base_url}{path}").status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError("Сервер не запустился")
+
+
+def text_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"},
+            "text": text,
+        },
+    }
+
+
+async def post_updates(base_url: str, updates: list, concurrency: int) -> list:
+    import aiohttp
+
+    latencies = []
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+
+    async def sender(session):
+        while not queue.empty():
+            update = queue.get_nowait()
+            started = time.perf_counter()
+            async with session.post(f"{base_url}/webhook", json=update) as response:
+                await response.read()
+            latencies.append(time.perf_counter() - started)
+            if response.status != 200:
+                # 503 при переполненной очереди: повторяем, как это делает Telegram
+                queue.put_nowait(update)
+                await asyncio.sleep(0.05)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+    return latencies
+
+
+def user_calls(calls: Counter, method: str) -> int:
+    return calls[method] - calls[f'admin:{method}']
+
+
+def wait_calls(api: FakeBotAPI, method: str, expected: int, timeout: float = 120.0) -> Counter:
+    # Ждем ответов пользователям; сообщения в чат администраторов не считаются
+    deadline = time.monotonic() + timeout
+    calls = api.calls()
+    while user_calls(calls, method) < expected and time.monotonic() < deadline:
+        time.sleep(0.05)
+        calls = api.calls()
+    return calls
+
+
+# ===== Webhook: масштабирование по числу воркеров =====
+def bench_webhook(args):
+    api = FakeBotAPI()
+    api.start()
+    results = []
+    try:
+        for workers in args.workers:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                proc, base_url = start_server(app_env(api, tmpdir), workers)
+                try:
+                    # Каждое /start порождает ровно один sendMessage
+                    updates = [text_update(i + 1, 1000 + i % args.chats, '/start') for i in range(args.updates)]
+                    api.reset()
+                    started = time.perf_counter()
+                    asyncio.run(post_updates(base_url, updates, args.concurrency))
+                    handled = user_calls(wait_calls(api, 'sendMessage', args.updates), 'sendMessage')
+                    elapsed = time.perf_counter() - started
+                    results.append({
+                        "workers": workers,
+                        "updates": args.updates,
+                        "handled": handled,
+                        "seconds": round(elapsed, 3),
+                        "updates_per_sec": round(handled / elapsed, 1),
+                    })
+                finally:
+                    proc.terminate()
+                    proc.wait()
+    finally:
+        api.stop()
+    report("webhook", {"runs": results}, args)
+
+
+# ===== Маршрутизация кнопок: цепочка фильтров против таблицы =====
+def routing_dispatcher(mode: str, languages: int, buttons: int):
+    from aiogram import Dispatcher, F, Router
+
+    texts = [[f'btn{b} lang{l}' for l in range(languages)] for b in range(buttons)]
+    dp = Dispatcher()
+    router = Router()
+    dp.include_router(router)
+
+    async def noop(message):
+        pass
+
+    if mode == "filters":
+        # Как было в legalbot: по обработчику на кнопку, endswith для каждого языка
+        for variants in texts:
+            flt = F.text.endswith(variants[0])
+            for text in variants[1:]:
+                flt = flt | F.text.endswith(text)
+            router.message(flt)(noop)
+    else:
+        routes = {text: b for b, variants in enumerate(texts) for text in variants}
+        router.message(F.text.in_(routes))(noop)
+    return dp, texts[-1][-1]
+
+
+def bench_routing(args):
+    from aiogram import Bot
+    from aiogram.types import Update
+
+    bot = Bot("123456:bench")
+
+    async def run() -> list:
+        results = []
+        for languages, buttons in ((2, 6), (5, 20), (10, 50)):
+            timings = {}
+            for mode in ("filters", "table"):
+                dp, worst_text = routing_dispatcher(mode, languages, buttons)
+                updates = [
+                    Update.model_validate(text_update(i, i % 100 + 1, worst_text), context={"bot": bot})
+                    for i in range(args.updates)
+                ]
+                started = time.perf_counter()
+                for update in updates:
+                    await dp.feed_update(bot, update)
+                timings[mode] = round((time.perf_counter() - started) / len(updates) * 1e6, 1)
+            results.append({"languages": languages, "buttons": buttons, "us_per_update": timings})
+        await bot.session.close()
+        return results
+
+    report("routing", {"updates": args.updates, "runs": asyncio.run(run())}, args)
+
+
+# ===== Клавиатуры: сборка и сериализация на каждый ответ против готовых =====
+def bench_keyboards(args):
+    import tracemalloc
+    import legalbot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.methods import SendMessage
+
+    plain = AiohttpSession()
+    cached = legalbot.CachedMarkupSession()
+    t = legalbot.translations['ru']
+
+    def rebuilt_reply():
+        # Как было: новая клавиатура и полная сериализация на каждый ответ
+        method = SendMessage(chat_id=1, text=t['menu'], reply_markup=legalbot.build_menu(t))
+        return plain.build_form_data(legalbot.bot, method)
+
+    def frozen_reply():
+        method = SendMessage(chat_id=1, text=t['menu'], reply_markup=legalbot.get_menu('ru'))
+        return cached.build_form_data(legalbot.bot, method)
+
+    fields = lambda form: [(opts['name'], value) for opts, _, value in form._fields]
+    assert fields(rebuilt_reply()) == fields(frozen_reply()), "кэшированная форма отличается от исходной"
+
+    results = {}
+    for name, reply in (("rebuilt", rebuilt_reply), ("frozen", frozen_reply)):
+        started = time.perf_counter()
+        for _ in range(args.updates):
+            reply()
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        reply()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        reply()
+        peak = tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        results[name] = {"us_per_reply": round(elapsed / args.updates * 1e6, 1), "peak_bytes_per_reply": peak}
+
+    report("keyboards", {"replies": args.updates, **results}, args)
+
+
+# ===== Flow: полная анкета тысяч пользователей и нагрузка на админку =====
+def document_update(update_id: int, chat_id: int, index: int) -> dict:
+    update = text_update(update_id, chat_id, '')
+    message = update["message"]
+    del message["text"]
+    message["document"] = {
+        "file_id": f"F{chat_id}_{index}",
+        "file_unique_id": f"U{chat_id}_{index}",
+        "file_name": f"doc{index}.pdf",
+        "mime_type": "application/pdf",
+        "file_size": 100 * 1024,
+    }
+    return update
+
+
+def user_flow(chat_id: int, docs: int, next_id) -> list:
+    steps = ['/start', '📝 Записаться на консультацию', f'Клиент {chat_id}', '+70000000000',
+             f'Проблема с договором аренды №{chat_id}']
+    updates = [text_update(next(next_id), chat_id, text) for text in steps]
+    updates += [document_update(next(next_id), chat_id, i) for i in range(docs)]
+    updates.append(text_update(next(next_id), chat_id, '/done'))
+    return updates
+
+
+def latency_summary(latencies: list) -> dict:
+    if not latencies:
+        return {"count": 0}
+    ordered = sorted(latencies)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+    return {"count": len(ordered), "p50_ms": pick(0.5), "p99_ms": pick(0.99), "max_ms": round(ordered[-1] * 1000, 2)}
+
+
+def db_size(path: str) -> int:
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+
+
+async def drive_flow(base_url: str, flows: list, concurrency: int) -> list:
+    import aiohttp
+
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def walk(session, updates):
+        # Шаги одного пользователя идут строго по очереди, как в настоящем чате
+        async with semaphore:
+            for update in updates:
+                while True:
+                    started = time.perf_counter()
+                    async with session.post(f"{base_url}/webhook", json=update) as response:
+                        await response.read()
+                    latencies.append(time.perf_counter() - started)
+                    if response.status == 200:
+                        break
+                    await asyncio.sleep(0.05)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(walk(session, updates) for updates in flows))
+    return latencies
+
+
+async def drive_admin(base_url: str, stop: asyncio.Event, clients: int) -> dict:
+    import aiohttp
+
+    latencies = {"requests": [], "search": [], "update": []}
+
+    async def timed(name, call):
+        started = time.perf_counter()
+        async with call as response:
+            body = await response.json()
+        latencies[name].append(time.perf_counter() - started)
+        return body
+
+    async def client(session):
+        while not stop.is_set():
+            page = await timed("requests", session.get(f"{base_url}/admin/api/requests", params={"limit": 50}))
+            await timed("search", session.get(f"{base_url}/admin/api/search", params={"q": "договор"}))
+            # Без текста ответа: смена статуса не порождает сообщений в Bot API
+            for item in page["items"][:5]:
+                await timed("update", session.post(
+                    f"{base_url}/admin/update", data={"request_id": item["id"], "status": "in_progress"}
+                ))
+            await asyncio.sleep(0.05)
+
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as session:
+        async with session.post(f"{base_url}/admin/login", data={"username": "admin", "password": "1234"},
+                                allow_redirects=False) as response:
+            assert response.status == 302, "не удалось войти в админку"
+        await asyncio.gather(*(client(session) for _ in range(clients)))
+    return {name: latency_summary(values) for name, values in latencies.items()}
+
+
+def bench_flow(args):
+    import sqlite3
+
+    api = FakeBotAPI()
+    api.start()
+    results = []
+    try:
+        for workers in args.workers:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                env = app_env(api, tmpdir)
+                proc, base_url = start_server(env, workers)
+                try:
+                    next_id = iter(range(1, sys.maxsize))
+                    flows = [user_flow(100000 + i, args.docs, next_id) for i in range(args.chats)]
+                    total_updates = sum(len(updates) for updates in flows)
+                    # Каждое обновление анкеты получает ровно один ответ sendMessage
+                    api.reset()
+                    size_before = db_size(env['DATABASE_PATH'])
+
+                    async def run():
+                        stop = asyncio.Event()
+                        admin = asyncio.create_task(drive_admin(base_url, stop, args.admin_clients))
+                        latencies = await drive_flow(base_url, flows, args.concurrency)
+                        await asyncio.to_thread(wait_calls, api, 'sendMessage', total_updates)
+                        stop.set()
+                        return latencies, await admin
+
+                    started = time.perf_counter()
+                    webhook_latencies, admin_latencies = asyncio.run(run())
+                    elapsed = time.perf_counter() - started
+                    handled = user_calls(api.calls(), 'sendMessage')
+
+                    # Архив документов догоняет в фоне после ответа пользователю
+                    archive_deadline = time.monotonic() + 120
+                    with sqlite3.connect(env['DATABASE_PATH']) as conn:
+                        rows = conn.execute("SELECT COUNT(*) FROM requests").fetchone()[0]
+                        documents = conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+                        while True:
+                            archived = conn.execute(
+                                "SELECT COUNT(*) FROM documents WHERE storage_key IS NOT NULL"
+                            ).fetchone()[0]
+                            if archived >= documents or time.monotonic() > archive_deadline:
+                                break
+                            time.sleep(0.1)
+                    archive_seconds = time.perf_counter() - started - elapsed
+                    calls = api.calls()
+                    size_after = db_size(env['DATABASE_PATH'])
+                    results.append({
+                        "workers": workers,
+                        "users": args.chats,
+                        "updates": total_updates,
+                        "handled": handled,
+                        "seconds": round(elapsed, 3),
+                        "updates_per_sec": round(handled / elapsed, 1),
+                        "webhook": latency_summary(webhook_latencies),
+                        "admin": admin_latencies,
+                        "requests_saved": rows,
+                        "documents_saved": documents,
+                        "documents_archived": archived,
+                        "archive_lag_seconds": round(archive_seconds, 3),
+                        "admin_chat_calls": {method[len('admin:'):]: count for method, count in calls.items()
+                                             if method.startswith('admin:')},
+                        "db_bytes_before": size_before,
+                        "db_bytes_after": size_after,
+                        "db_bytes_per_request": round((size_after - size_before) / max(rows, 1)),
+                    })
+                finally:
+                    proc.terminate()
+                    proc.wait()
+    finally:
+        api.stop()
+    report("flow", {"docs_per_user": args.docs, "admin_clients": args.admin_clients, "runs": results}, args)
+
+
+# ===== Export: потоковая выгрузка против загрузки всех строк =====
+def bench_export(args):
+    import tracemalloc
+    import legalbot
+
+    async def consume(stream) -> int:
+        size = 0
+        async for chunk in stream:
+            size += len(chunk)
+        return size
+
+    async def load_all() -> int:
+        # Как работал бы api_requests без пагинации: все строки и документы в одном списке
+        async with legalbot.db.read() as conn:
+            rows = await (await conn.execute("SELECT * FROM requests ORDER BY created_at, id")).fetchall()
+            documents = await legalbot.fetch_documents(conn, [r["id"] for r in rows])
+        return len(json.dumps([{**dict(r), "documents": documents[r["id"]]} for r in rows], ensure_ascii=False))
+
+    async def measure(name, make) -> dict:
+        tracemalloc.start()
+        started = time.perf_counter()
+        size = await make()
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {"format": name, "seconds": round(elapsed, 2), "bytes": size, "peak_mb": round(peak / 2**20, 2)}
+
+    async def run() -> list:
+        await legalbot.db.open()
+        await legalbot.init_db()
+        results = []
+        seeded = 0
+        for rows in (args.rows // 4, args.rows):
+            await seed_requests(legalbot.DB_PATH, rows - seeded)
+            seeded = rows
+            for name, writer in legalbot.EXPORT_WRITERS.items():
+                result = await measure(name, lambda: consume(writer(legalbot.iter_export_rows([], []))))
+                results.append({"rows": rows, **result})
+            results.append({"rows": rows, **await measure("load_all", load_all)})
+        await legalbot.db.close()
+        return results
+
+    report("export", {"batch_size": legalbot.EXPORT_BATCH_SIZE, "runs": asyncio.run(run())}, args)
+
+
+# ===== Parse: разбор входящих обновлений и пропускная способность /webhook =====
+WEBHOOK_SECRET = 'bench-secret'
+
+
+def update_mix(count: int) -> list:
+    # Из 20 обновлений: 16 сообщений, 3 типа без обработчиков и 1 испорченное
+    bodies = []
+    for i in range(count):
+        update = text_update(i + 1, 1000 + i % 200, '/start')
+        kind = i % 20
+        if kind >= 19:
+            del update["message"]["chat"]
+        elif kind >= 16:
+            update["edited_message"] = update.pop("message")
+        bodies.append(json.dumps(update).encode())
+    return bodies
+
+
+async def post_bodies(base_url: str, bodies: list, concurrency: int, headers: dict) -> Counter:
+    import aiohttp
+
+    statuses = Counter()
+    queue = asyncio.Queue()
+    for body in bodies:
+        queue.put_nowait(body)
+
+    async def sender(session):
+        while not queue.empty():
+            body = queue.get_nowait()
+            async with session.post(f"{base_url}/webhook", data=body, headers=headers) as response:
+                await response.read()
+            statuses[response.status] += 1
+            if response.status == 503:
+                queue.put_nowait(body)
+                await asyncio.sleep(0.05)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+    return statuses
+
+
+def bench_parse(args):
+    import legalbot
+    from aiogram import types
+
+    bodies = update_mix(args.updates)
+    messages = sum(b'"message"' in body and b'"chat"' in body for body in bodies)
+    legalbot.webhook_update_types.update(legalbot.dp.resolve_used_update_types())
+
+    def legacy(body: bytes):
+        # Как было: json, полная валидация любого типа и повторный разбор при ошибке
+        data = json.loads(body)
+        try:
+            return types.Update.model_validate(data)
+        except Exception:
+            return types.Update(**data)
+
+    def current(body: bytes):
+        return legalbot.parse_update(body)[1]
+
+    def mount(update):
+        # Что делает Dispatcher.feed_update с обновлением, разобранным без контекста бота
+        if update is not None and update.bot != legalbot.bot:
+            types.Update.model_validate(update.model_dump(), context={"bot": legalbot.bot})
+
+    parsing = {}
+    for name, parse in (("legacy", legacy), ("current", current)):
+        started = time.perf_counter()
+        for body in bodies:
+            try:
+                mount(parse(body))
+            except Exception:
+                pass
+        parsing[name] = {"us_per_update": round((time.perf_counter() - started) / len(bodies) * 1e6, 1)}
+
+    api = FakeBotAPI()
+    api.start()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            proc, base_url = start_server(app_env(api, tmpdir, WEBHOOK_SECRET=WEBHOOK_SECRET), 1)
+            try:
+                api.reset()
+                headers = {'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET, 'Content-Type': 'application/json'}
+                forged = bodies[:len(bodies) // 10]
+                started = time.perf_counter()
+                statuses = asyncio.run(post_bodies(base_url, bodies, args.concurrency, headers))
+                accepted_seconds = time.perf_counter() - started
+                handled = user_calls(wait_calls(api, 'sendMessage', messages), 'sendMessage')
+                handled_seconds = time.perf_counter() - started
+                started = time.perf_counter()
+                forged_statuses = asyncio.run(post_bodies(
+                    base_url, forged, args.concurrency, {**headers, 'X-Telegram-Bot-Api-Secret-Token': 'forged'}
+                ))
+                forged_seconds = time.perf_counter() - started
+            finally:
+                proc.terminate()
+                proc.wait()
+    finally:
+        api.stop()
+
+    report("parse", {
+        "updates": len(bodies),
+        "parsing": parsing,
+        "endpoint": {
+            "statuses": dict(statuses),
+            "requests_per_sec": round(len(bodies) / accepted_seconds, 1),
+            "messages": messages,
+            "handled": handled,
+            "handled_per_sec": round(handled / handled_seconds, 1),
+        },
+        "forged": {
+            "statuses": dict(forged_statuses),
+            "requests_per_sec": round(len(forged) / forged_seconds, 1),
+        },
+    }, args)
+
+
+# ===== Startup: импорт модуля и время до первого ответа =====
+# Замерено ~2.1 с на импорт и ~2.4 с до первого /webhook; запас — на шум общих CI-машин
+STARTUP_BUDGET = 4.0
+
+
+def import_profile(env: dict) -> tuple:
+    # -X importtime пишет в stderr: self и cumulative в микросекундах для каждого модуля
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import legalbot'],
+                          env=env, capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    modules, children = [], []
+    total = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        # Дочерние модули печатаются до родителя: прямые импорты legalbot копятся до его строки
+        if depth == 1:
+            children.append((int(cumulative_us), name.strip()))
+        elif depth == 0:
+            if name.strip() == 'legalbot':
+                total, modules = int(cumulative_us), children
+            children = []
+    return total, sorted(modules, reverse=True)
+
+
+def first_response(env: dict, timeout: float = 60.0) -> dict:
+    import httpx
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'legalbot:app', '--host', '127.0.0.1',
+         '--port', str(port), '--log-level', 'warning'],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client() as client:
+            deadline = started + timeout
+            while time.perf_counter() < deadline:
+                try:
+                    if client.get(f"{base_url}/health/live").status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                time.sleep(0.01)
+            else:
+                raise RuntimeError("Сервер не запустился")
+            live = time.perf_counter() - started
+            client.post(f"{base_url}/webhook", json=text_update(1, 1, '/start')).raise_for_status()
+            webhook = time.perf_counter() - started
+    finally:
+        proc.terminate()
+        proc.wait()
+    return {"live": live, "webhook": webhook}
+
+
+def bench_startup(args):
+    import statistics
+
+    api = FakeBotAPI()
+    api.start()
+    try:
+        imports = []
+        runs = []
+        for _ in range(args.repeat):
+            # Каждый прогон — холодный старт на пустом каталоге, как после редеплоя
+            with tempfile.TemporaryDirectory() as tmpdir:
+                env = app_env(api, tmpdir)
+                total, modules = import_profile(env)
+                imports.append(total)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                runs.append(first_response(app_env(api, tmpdir)))
+    finally:
+        api.stop()
+
+    import_seconds = statistics.median(imports) / 1e6
+    live = statistics.median(run["live"] for run in runs)
+    webhook = statistics.median(run["webhook"] for run in runs)
+    result = {
+        "repeat": args.repeat,
+        "import_seconds": round(import_seconds, 3),
+        "top_imports": [{"module": name, "seconds": round(us / 1e6, 3)} for us, name in modules[:10]],
+        "first_live_seconds": round(live, 3),
+        "first_webhook_seconds": round(webhook, 3),
+    }
+    budget = args.budget or STARTUP_BUDGET
+    result["budget_seconds"] = budget
+    result["within_budget"] = webhook <= budget
+    report("startup", result, args)
+    # Ненулевой код выхода позволяет гонять сценарий в CI как проверку регрессии
+    return 0 if webhook <= budget else 1
+
+
+SCENARIOS = {
+    "db": bench_db,
+    "webhook": bench_webhook,
+    "insert": bench_insert,
+    "fake-api": serve_fake_api,
+    "routing": bench_routing,
+    "keyboards": bench_keyboards,
+    "flow": bench_flow,
+    "export": bench_export,
+    "parse": bench_parse,
+    "startup": bench_startup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки LegalBot")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--docs", type=int, default=2, help="документов на пользователя в flow")
+    parser.add_argument("--admin-clients", type=int, default=2, help="параллельных клиентов админки в flow")
+    parser.add_argument("--file-size", type=int, default=100 * 1024, help="размер файла в поддельном Bot API")
+    parser.add_argument("--repeat", type=int, default=5, help="повторов холодного старта в startup")
+    parser.add_argument("--budget", type=float, help=f"предел времени до первого ответа /webhook в startup, секунды (по умолчанию {STARTUP_BUDGET})")
+    parser.add_argument("--output", help="сохранить результат в JSON-файл")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        setup_env(tmpdir)
+        return SCENARIOS[args.scenario](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,30 +2,58 @@ import logging
 import aiohttp
 import os
 import asyncio
-from datetime import datetime, timezone
+import base64
+import csv
+import io
+import zipfile
+import hashlib
+import hmac
+import html
+import re
+import sys
+import sqlite3
+import fcntl
+import json
+import time
+import random
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta, timezone
 import aiosqlite
+import orjson
 from contextlib import asynccontextmanager
-from urllib.parse import urljoin
-from typing import List, Optional
+from urllib.parse import quote, urljoin
+from xml.sax.saxutils import escape as xml_escape
+from typing import Any, Dict, List, Optional, Tuple
 
 from aiogram import Router
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, StateType, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InputFile, InputMediaDocument
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer, PRODUCTION
+from aiogram.methods.base import TelegramMethod, TelegramType
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from fastapi import FastAPI, Request, Form, HTTPException
 from fastapi.responses import RedirectResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
 from dotenv import load_dotenv
+from redis.asyncio import Redis
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
-from io import BytesIO
-import uvicorn
+from fastapi.responses import Response
+from pydantic import ValidationError
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest
+import aiofiles
 
 # ===== НАСТРОЙКА ЛОГИРОВАНИЯ =====
 logging.basicConfig(
@@ -36,12 +64,6 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 load_dotenv()
 
-# Логирование версий библиотек
-import aiogram
-import fastapi
-logger.info(f"aiogram version: {aiogram.__version__}")
-logger.info(f"fastapi version: {fastapi.__version__}")
-
 # ===== КОНСТАНТЫ =====
 MAX_DOCUMENT_SIZE = 20 * 1024 * 1024  # 20 MB
 ALLOWED_DOCUMENT_TYPES = {
@@ -52,130 +74,1280 @@ ALLOWED_DOCUMENT_TYPES = {
     'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
 }
 
+DB_PATH = os.getenv('DATABASE_PATH', 'bot.db')
+
+# ===== НЕСКОЛЬКО ВОРКЕРОВ =====
+# Число процессов uvicorn; при >1 состояние FSM и блокировки чатов общие
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '1'))
+PORT = int(os.getenv('PORT', '8080'))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+SESSION_SECRET = os.getenv('SESSION_SECRET') or os.getenv('SECRET_KEY')
+STARTUP_LOCK_PATH = f"{DB_PATH}.lock"
+FSM_LOCK_TTL = 30.0
+FSM_LOCK_POLL = 0.02
+
+@asynccontextmanager
+async def startup_lock():
+    # Межпроцессная блокировка: воркеры по очереди выполняют инициализацию
+    with open(STARTUP_LOCK_PATH, 'w') as lock_file:
+        await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# ===== МЕТРИКИ =====
+# Метрики Prometheus отдаются на /metrics. При нескольких воркерах задайте PROMETHEUS_MULTIPROC_DIR
+# (пустой каталог, очищается перед запуском) — тогда /metrics суммирует все процессы
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+# Доля входящих обновлений, которые пишутся в лог целиком (0 — не писать)
+LOG_UPDATES_SAMPLE = float(os.getenv('LOG_UPDATES_SAMPLE', '0'))
+
+HANDLER_SECONDS = Histogram(
+    'legalbot_handler_seconds', 'Время обработчика aiogram', ['handler']
+)
+HANDLER_ERRORS = Counter(
+    'legalbot_handler_errors_total', 'Исключения в обработчиках aiogram', ['handler']
+)
+HTTP_SECONDS = Histogram(
+    'legalbot_http_request_seconds', 'Время обработки HTTP-запроса', ['method', 'route', 'status']
+)
+DB_SECONDS = Histogram(
+    'legalbot_db_query_seconds', 'Время работы с SQLite внутри db.read()/db.write()', ['mode', 'query']
+)
+DB_WAIT_SECONDS = Histogram(
+    'legalbot_db_wait_seconds', 'Ожидание соединения из пула или блокировки записи', ['mode']
+)
+TELEGRAM_SECONDS = Histogram(
+    'legalbot_telegram_api_seconds', 'Время вызова Telegram Bot API', ['method']
+)
+TELEGRAM_ERRORS = Counter(
+    'legalbot_telegram_api_errors_total', 'Ошибки вызовов Telegram Bot API', ['method', 'error']
+)
+FORM_STEPS = Counter(
+    'legalbot_form_steps_total', 'Переходы по шагам анкеты (воронка)', ['step']
+)
+
+# Время каждого обработчика сообщений; имя берется из функции-обработчика
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else 'unknown'
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+# Время и ошибки всех вызовов Bot API, включая очередь исходящих и скачивание файлов
+class TelegramAPIMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        api_method = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_ERRORS.labels(api_method, type(e).__name__).inc()
+            raise
+        finally:
+            TELEGRAM_SECONDS.labels(api_method).observe(time.perf_counter() - started)
+
+def render_metrics() -> bytes:
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+# ===== ХРАНИЛИЩЕ FSM =====
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')  # sqlite | redis | memory
+FSM_DB_PATH = os.getenv('FSM_DATABASE_PATH', os.path.join(os.path.dirname(DB_PATH), 'fsm.db'))
+FSM_TTL = int(os.getenv('FSM_TTL', str(24 * 60 * 60)))  # незаконченные анкеты живут сутки
+FSM_PURGE_EVERY = 1000
+REDIS_URL = os.getenv('REDIS_URL')
+
+def storage_key_str(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+def state_str(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+def json_set_args(data: Dict[str, Any]) -> Tuple[str, List]:
+    # json_set по ключам верхнего уровня повторяет семантику dict.update
+    paths, params = [], []
+    for name, value in data.items():
+        paths.append("?, json(?)")
+        params.extend(['$."' + name.replace('"', '""') + '"', json.dumps(value, ensure_ascii=False)])
+    return ", ".join(paths), params
+
+# Хранилище FSM в отдельном файле SQLite (WAL) с TTL на каждый ключ.
+# Переживает перезапуски и общее для всех воркеров одного хоста.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str, ttl: int = FSM_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._connect_lock = asyncio.Lock()
+        self._writes = 0
+
+    async def open(self):
+        await self._connection()
+
+    async def _connection(self) -> aiosqlite.Connection:
+        if self._conn is not None:
+            return self._conn
+        async with self._connect_lock:
+            if self._conn is None:
+                # Автокоммит и execute_fetchall: каждый оператор выполняется до конца
+                # за один вызов, поэтому ни снимок чтения, ни блокировка записи
+                # не удерживаются между await (иначе другой воркер получит SQLITE_BUSY)
+                conn = await aiosqlite.connect(self.path, isolation_level=None)
+                await conn.execute("PRAGMA journal_mode=WAL")
+                await conn.execute("PRAGMA synchronous=NORMAL")
+                await conn.execute("PRAGMA busy_timeout=5000")
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS fsm_storage (
+                        key TEXT PRIMARY KEY,
+                        state TEXT,
+                        data TEXT NOT NULL DEFAULT '{}',
+                        expires_at REAL NOT NULL
+                    )
+                """)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS fsm_locks (
+                        key TEXT PRIMARY KEY,
+                        owner TEXT NOT NULL,
+                        expires_at REAL NOT NULL
+                    )
+                """)
+                self._conn = conn
+        return self._conn
+
+    async def _write(self, sql: str, params: List) -> Optional[tuple]:
+        conn = await self._connection()
+        rows = await conn.execute_fetchall(sql, params)
+        self._writes += 1
+        if self._writes % FSM_PURGE_EVERY == 0:
+            await self.purge_expired()
+        return rows[0] if rows else None
+
+    async def _read(self, column: str, key: StorageKey) -> Optional[tuple]:
+        conn = await self._connection()
+        rows = await conn.execute_fetchall(
+            f"SELECT {column} FROM fsm_storage WHERE key = ? AND expires_at > ?",
+            (storage_key_str(key), time.time())
+        )
+        return rows[0] if rows else None
+
+    async def update_state_data(
+        self,
+        key: StorageKey,
+        state: StateType = None,
+        data: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        # Смена состояния и слияние данных одним запросом вместо get + set + set_state
+        now = time.time()
+        paths, params = json_set_args(data or {})
+        current = "CASE WHEN fsm_storage.expires_at > ? THEN fsm_storage.data ELSE '{}' END"
+        initial = f"json_set('{{}}', {paths})" if paths else "'{}'"
+        merged = f"json_set({current}, {paths})" if paths else current
+        row = await self._write(
+            f"""INSERT INTO fsm_storage (key, state, data, expires_at)
+            VALUES (?, ?, {initial}, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                state = excluded.state,
+                data = {merged},
+                expires_at = excluded.expires_at
+            RETURNING data""",
+            [storage_key_str(key), state_str(state), *params, now + self.ttl, now, *params]
+        )
+        return json.loads(row[0])
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        now = time.time()
+        await self._write(
+            """INSERT INTO fsm_storage (key, state, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                state = excluded.state,
+                data = CASE WHEN fsm_storage.expires_at > ? THEN fsm_storage.data ELSE '{}' END,
+                expires_at = excluded.expires_at""",
+            [storage_key_str(key), state_str(state), now + self.ttl, now]
+        )
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._read("state", key)
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        now = time.time()
+        await self._write(
+            """INSERT INTO fsm_storage (key, data, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                state = CASE WHEN fsm_storage.expires_at > ? THEN fsm_storage.state END,
+                data = excluded.data,
+                expires_at = excluded.expires_at""",
+            [storage_key_str(key), json.dumps(data, ensure_ascii=False), now + self.ttl, now]
+        )
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._read("data", key)
+        return json.loads(row[0]) if row else {}
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        now = time.time()
+        paths, params = json_set_args(data)
+        if not paths:
+            return await self.get_data(key)
+        row = await self._write(
+            f"""INSERT INTO fsm_storage (key, data, expires_at)
+            VALUES (?, json_set('{{}}', {paths}), ?)
+            ON CONFLICT(key) DO UPDATE SET
+                state = CASE WHEN fsm_storage.expires_at > ? THEN fsm_storage.state END,
+                data = json_set(
+                    CASE WHEN fsm_storage.expires_at > ? THEN fsm_storage.data ELSE '{{}}' END,
+                    {paths}
+                ),
+                expires_at = excluded.expires_at
+            RETURNING data""",
+            [storage_key_str(key), *params, now + self.ttl, now, now, *params]
+        )
+        return json.loads(row[0])
+
+    async def purge_expired(self):
+        await self._write("DELETE FROM fsm_storage WHERE expires_at <= ?", [time.time()])
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+# Redis-хранилище aiogram с TTL; смена состояния и данных уходит одним pipeline
+class RedisFSMStorage(RedisStorage):
+    async def update_state_data(
+        self,
+        key: StorageKey,
+        state: StateType = None,
+        data: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        current = await self.get_data(key)
+        current.update(data or {})
+        state_key = self.key_builder.build(key, "state")
+        data_key = self.key_builder.build(key, "data")
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if state is None:
+                pipe.delete(state_key)
+            else:
+                pipe.set(state_key, state_str(state), ex=self.state_ttl)
+            pipe.set(data_key, json.dumps(current), ex=self.data_ttl)
+            await pipe.execute()
+        return current.copy()
+
+# Блокировка чата между воркерами через таблицу fsm_locks того же файла SQLite
+class SQLiteEventIsolation(BaseEventIsolation):
+    def __init__(self, storage: SQLiteStorage, ttl: float = FSM_LOCK_TTL):
+        self.storage = storage
+        self.ttl = ttl
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey):
+        name = storage_key_str(key)
+        owner = f"{os.getpid()}:{id(asyncio.current_task())}"
+        while True:
+            now = time.time()
+            # Захват удается, если блокировки нет или она просрочена
+            acquired = await self.storage._write(
+                """INSERT INTO fsm_locks (key, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    owner = excluded.owner,
+                    expires_at = excluded.expires_at
+                WHERE fsm_locks.expires_at <= ?
+                RETURNING owner""",
+                [name, owner, now + self.ttl, now]
+            )
+            if acquired:
+                break
+            await asyncio.sleep(FSM_LOCK_POLL)
+        try:
+            yield
+        finally:
+            await self.storage._write(
+                "DELETE FROM fsm_locks WHERE key = ? AND owner = ?", [name, owner]
+            )
+
+    async def close(self) -> None:
+        pass
+
+def create_storage() -> BaseStorage:
+    if FSM_STORAGE == 'redis':
+        if not REDIS_URL:
+            raise ValueError("FSM_STORAGE=redis требует REDIS_URL")
+        return RedisFSMStorage.from_url(REDIS_URL, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+    if FSM_STORAGE == 'memory':
+        return MemoryStorage()
+    return SQLiteStorage(FSM_DB_PATH)
+
+def create_isolation(storage: BaseStorage) -> Optional[BaseEventIsolation]:
+    # В одном процессе порядок по чату обеспечивает очередь обновлений
+    if WEB_CONCURRENCY <= 1:
+        return None
+    if isinstance(storage, RedisStorage):
+        return storage.create_isolation()
+    if isinstance(storage, SQLiteStorage):
+        return SQLiteEventIsolation(storage)
+    logger.warning("FSM_STORAGE=memory не разделяется между воркерами")
+    return None
+
+async def advance(state: FSMContext, new_state: StateType, **data) -> Dict[str, Any]:
+    # Переход по шагам анкеты за одно обращение к хранилищу, если оно это умеет
+    FORM_STEPS.labels(new_state.state.split(':')[-1]).inc()
+    update_state_data = getattr(state.storage, 'update_state_data', None)
+    if update_state_data is not None:
+        return await update_state_data(state.key, new_state, data)
+    await state.set_state(new_state)
+    return await state.update_data(**data)
+
+# ===== ЗАЩИТА ОТ ФЛУДА =====
+# У каждого пользователя своя корзина токенов: THROTTLE_BURST сообщений подряд, дальше
+# THROTTLE_RATE в секунду. Лишние обновления отбрасываются до фильтров, FSM и базы.
+# Части одного альбома списывают один токен. Документы считаются в отдельной корзине,
+# чтобы анкета с UPLOAD_MAX_FILES файлами, отправленными по одному, проходила целиком.
+# О пропуске обновлений пользователь узнает одним сообщением за период ограничения.
+# Корзина, простоявшая burst/rate секунд, снова полна, поэтому такие записи забываются
+# без потери точности
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', '1'))  # 0 — без ограничения
+THROTTLE_BURST = float(os.getenv('THROTTLE_BURST', '10'))
+THROTTLE_DOCUMENT_BURST = float(os.getenv('THROTTLE_DOCUMENT_BURST', '20'))  # не меньше UPLOAD_MAX_FILES
+THROTTLE_USERS = int(os.getenv('THROTTLE_USERS', '10000'))  # предел локальных корзин (LRU)
+# THROTTLE_REDIS=1: корзины общие для всех воркеров и хранятся в REDIS_URL
+THROTTLE_REDIS = os.getenv('THROTTLE_REDIS') == '1'
+
+THROTTLED_UPDATES = Counter(
+    'legalbot_throttled_updates_total', 'Обновления, отброшенные защитой от флуда', ['event']
+)
+
+# Та же корзина токенов атомарно в Redis; ключ истекает, когда корзина снова полна
+THROTTLE_SCRIPT = """
+local rate, capacity, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 't', 'u')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 't', tostring(tokens), 'u', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return allowed
+"""
+
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, rate: float = THROTTLE_RATE, burst: float = THROTTLE_BURST,
+                 max_users: int = THROTTLE_USERS, redis=None, owns_redis: bool = False,
+                 document_burst: float = THROTTLE_DOCUMENT_BURST):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.document_burst = max(1.0, document_burst)
+        self.max_users = max_users
+        self.idle = max(self.burst, self.document_burst) / rate if rate > 0 else 0.0
+        self.dropped = 0
+        self._buckets: OrderedDict = OrderedDict()
+        self._albums: OrderedDict = OrderedDict()
+        self._warned: OrderedDict = OrderedDict()
+        self._redis = redis
+        self._owns_redis = owns_redis
+        self._script = redis.register_script(THROTTLE_SCRIPT) if redis is not None else None
+        self._redis_failed = False
+
+    async def __call__(self, handler, event: types.Update, data):
+        user = data.get('event_from_user')
+        if self.rate <= 0 or user is None:
+            return await handler(event, data)
+        group = getattr(event.message, 'media_group_id', None)
+        if group is not None and self._albums.get(user.id) == group:
+            return await handler(event, data)
+        document = getattr(event.message, 'document', None) is not None
+        if not await self._take(user.id, document):
+            self.dropped += 1
+            THROTTLED_UPDATES.labels(event.event_type).inc()
+            if event.message is not None:
+                await self._warn(event.message, user)
+            return UNHANDLED
+        if group is not None:
+            self._remember_album(user.id, group)
+        return await handler(event, data)
+
+    async def _take(self, user_id: int, document: bool = False) -> bool:
+        key, burst = (f"doc:{user_id}", self.document_burst) if document else (user_id, self.burst)
+        if self._script is None:
+            return self._take_local(key, burst)
+        try:
+            allowed = await self._script(keys=[f"throttle:{key}"], args=[self.rate, burst, time.time()])
+        except Exception as e:
+            # Redis недоступен: считаем в памяти процесса, а не пропускаем всех подряд
+            if not self._redis_failed:
+                logger.warning(f"Защита от флуда перешла на локальные счетчики: {e}")
+                self._redis_failed = True
+            return self._take_local(key, burst)
+        if self._redis_failed:
+            logger.info("Защита от флуда снова использует Redis")
+            self._redis_failed = False
+        return bool(allowed)
+
+    def _take_local(self, key, burst: float) -> bool:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, burst)
+        else:
+            self._buckets.move_to_end(key)
+        allowed = bucket.delay() == 0.0
+        self._evict()
+        return allowed
+
+    def _evict(self):
+        # В начале LRU самые давние корзины: забываем заполнившиеся и все сверх лимита
+        now = time.monotonic()
+        while self._buckets:
+            oldest = next(iter(self._buckets.values()))
+            if len(self._buckets) <= self.max_users and now - oldest.updated < self.idle:
+                break
+            self._buckets.popitem(last=False)
+
+    async def _warn(self, message: types.Message, user: types.User):
+        # Одно предупреждение за период ограничения: сами предупреждения не должны стать флудом
+        now = time.monotonic()
+        warned = self._warned.get(user.id)
+        if warned is not None and now - warned < self.idle:
+            return
+        self._warned[user.id] = now
+        self._warned.move_to_end(user.id)
+        if len(self._warned) > self.max_users:
+            self._warned.popitem(last=False)
+        t = translations.get(user.language_code) or translations[DEFAULT_LANG]
+        try:
+            await message.answer(t['throttled'])
+        except Exception as e:
+            logger.warning(f"Не удалось предупредить пользователя {user.id} о флуде: {e}")
+
+    def _remember_album(self, user_id: int, group: str):
+        self._albums[user_id] = group
+        self._albums.move_to_end(user_id)
+        if len(self._albums) > self.max_users:
+            self._albums.popitem(last=False)
+
+    async def close(self):
+        if self._owns_redis:
+            await self._redis.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "document_burst": self.document_burst,
+            "backend": "redis" if self._script is not None and not self._redis_failed else "memory",
+            "tracked_users": len(self._buckets),
+            "dropped": self.dropped,
+        }
+
+def create_throttling(storage: BaseStorage) -> ThrottlingMiddleware:
+    if not THROTTLE_REDIS:
+        return ThrottlingMiddleware()
+    if isinstance(storage, RedisStorage):
+        return ThrottlingMiddleware(redis=storage.redis)
+    if not REDIS_URL:
+        raise ValueError("THROTTLE_REDIS=1 требует REDIS_URL")
+    return ThrottlingMiddleware(redis=Redis.from_url(REDIS_URL), owns_redis=True)
+
 # ===== ИНИЦИАЛИЗАЦИЯ БОТА =====
 API_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')
+ADMIN_PANEL_URL = os.getenv('ADMIN_PANEL_URL', 'https://web-production-bb98.up.railway.app/admin')
 ALLOWED_ORIGINS = [origin for origin in os.getenv('ALLOWED_ORIGINS', '*').split(',') if origin]
 
 if not API_TOKEN:
     raise ValueError("BOT_TOKEN не установлен в .env")
 
+# Готовые клавиатуры из FROZEN_KEYBOARDS сериализуются один раз, дальше идет кэшированный JSON
+class CachedMarkupSession(AiohttpSession):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._markup_json: Dict[int, str] = {}
+
+    def build_form_data(self, bot: Bot, method: TelegramMethod[TelegramType]) -> aiohttp.FormData:
+        markup = getattr(method, 'reply_markup', None)
+        if markup is None or FROZEN_KEYBOARDS.get(id(markup)) is not markup:
+            return super().build_form_data(bot, method)
+
+        markup_json = self._markup_json.get(id(markup))
+        if markup_json is None:
+            markup_json = self._markup_json[id(markup)] = self.prepare_value(markup, bot=bot, files={})
+        form = aiohttp.FormData(quote_fields=False)
+        files: Dict[str, InputFile] = {}
+        for key, value in method.model_dump(warnings=False, exclude={'reply_markup'}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if value:
+                form.add_field(key, value)
+        form.add_field('reply_markup', markup_json)
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
+
 bot = Bot(
     token=API_TOKEN,
+    session=CachedMarkupSession(
+        api=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else PRODUCTION
+    ),
     default=DefaultBotProperties(parse_mode="HTML")
 )
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-router = Router()
-dp.include_router(router)
+bot.session.middleware(TelegramAPIMetrics())
+storage = create_storage()
+dp = Dispatcher(storage=storage, events_isolation=create_isolation(storage))
+# Защита от флуда встает между UserContextMiddleware и FSM: пользователь уже известен,
+# а отброшенное обновление не читает состояние и не ждет блокировку чата
+throttling = create_throttling(storage)
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(throttling)
+dp.update.outer_middleware(dp.fsm)
+dp.message.middleware(HandlerMetricsMiddleware())
+# Порядок важен: кнопки меню срабатывают раньше шагов анкеты
+menu_router = Router(name='menu')
+router = Router(name='form')
+dp.include_routers(menu_router, router)
 
 # ===== БАЗА ДАННЫХ =====
-async def init_db():
-    logger.info("Инициализация базы данных...")
-    try:
-        # Проверяем доступность файла базы данных (опционально)
-        if not os.path.exists('bot.db'):
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', str(64 * 1024 * 1024)))
+DB_CACHED_STATEMENTS = 256
+
+
+# Пул долгоживущих соединений SQLite: несколько читателей и один писатель.
+# Открывается и закрывается в lifespan приложения.
+class Database:
+    def __init__(self, path: str, pool_size: int = DB_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self.connects = 0
+        self._readers: Optional[asyncio.Queue] = None
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, cached_statements=DB_CACHED_STATEMENTS)
+        conn.row_factory = aiosqlite.Row
+        # Действует для новой базы; существующую переводит обслуживание (RetentionWorker)
+        await conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute("PRAGMA busy_timeout=5000")
+        await conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        self.connects += 1
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        if not os.path.exists(self.path):
             logger.warning("Файл базы данных не найден, будет создан новый")
+        # Писатель открывается первым: он переводит файл в режим WAL
+        self._writer = await self._connect()
+        self._readers = asyncio.Queue()
+        for _ in range(self.pool_size):
+            self._readers.put_nowait(await self._connect())
+        logger.info(f"Пул БД открыт: {self.path}, читателей: {self.pool_size}")
+
+    async def close(self):
+        if self._readers is not None:
+            while not self._readers.empty():
+                await self._readers.get_nowait().close()
+            self._readers = None
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    def idle_readers(self) -> int:
+        return self._readers.qsize() if self._readers is not None else 0
+
+    # query — короткое имя операции для метрик legalbot_db_query_seconds
+    @asynccontextmanager
+    async def read(self, query: str = 'read'):
+        started = time.perf_counter()
+        conn = await self._readers.get()
+        acquired = time.perf_counter()
+        DB_WAIT_SECONDS.labels('read').observe(acquired - started)
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+            DB_SECONDS.labels('read', query).observe(time.perf_counter() - acquired)
+
+    @asynccontextmanager
+    async def exclusive(self):
+        # Писатель без открытой транзакции: VACUUM и часть PRAGMA внутри BEGIN не работают
+        async with self._write_lock:
+            yield self._writer
+
+    @asynccontextmanager
+    async def write(self, query: str = 'write'):
+        # Все записи идут через одно соединение, транзакция фиксируется на выходе
+        started = time.perf_counter()
+        async with self._write_lock:
+            acquired = time.perf_counter()
+            DB_WAIT_SECONDS.labels('write').observe(acquired - started)
+            # Блокировка записи берется сразу, чтобы не повышать чтение до записи
+            await self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            finally:
+                DB_SECONDS.labels('write', query).observe(time.perf_counter() - acquired)
+
+
+db = Database(DB_PATH)
+
+# ===== МИГРАЦИИ =====
+# Схема меняется только нумерованными миграциями, примененные версии хранятся в schema_version.
+# Каждая миграция выполняется в своей транзакции BEGIN IMMEDIATE, а версия перечитывается
+# под этой блокировкой, поэтому одновременно стартующие воркеры не применят миграцию дважды.
+# Первые миграции повторяют прежнюю ручную инициализацию и безопасны для уже созданных баз
+MIGRATIONS: List[Tuple[int, str, Any]] = []
+
+def migration(version: int, name: str):
+    def register(apply):
+        MIGRATIONS.append((version, name, apply))
+        return apply
+    return register
+
+async def table_columns(conn: aiosqlite.Connection, table: str) -> List[str]:
+    return [col['name'] for col in await conn.execute_fetchall(f"PRAGMA table_info({table})")]
+
+@migration(1, "requests и documents")
+async def migrate_initial(conn: aiosqlite.Connection):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT,
+            phone TEXT,
+            message TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'new'
+        )
+    """)
+    # В самых старых базах таблица requests создана без user_id
+    if 'user_id' not in await table_columns(conn, 'requests'):
+        await conn.execute("ALTER TABLE requests ADD COLUMN user_id INTEGER")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id INTEGER,
+            file_id TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            sent_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (request_id) REFERENCES requests(id) ON DELETE CASCADE
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_request_id ON documents(request_id)")
+
+@migration(2, "индексы списка заявок")
+async def migrate_request_indexes(conn: aiosqlite.Connection):
+    # Составные индексы под keyset-пагинацию и фильтры админки
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_created ON requests(created_at, id)")
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_requests_status_created ON requests(status, created_at, id)"
+    )
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_requests_user_created ON requests(user_id, created_at, id)"
+    )
+
+@migration(3, "outbox")
+async def migrate_outbox(conn: aiosqlite.Connection):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            request_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            sent_at TEXT
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_request ON outbox(request_id)")
+
+@migration(4, "полнотекстовый индекс заявок")
+async def migrate_requests_fts(conn: aiosqlite.Connection):
+    rows = await conn.execute_fetchall(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'requests_fts'"
+    )
+    fts_exists = bool(rows)
+    await conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS requests_fts USING fts5(
+            name, phone, message,
+            content='requests',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    # Индекс синхронизируется триггерами
+    await conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS requests_fts_insert AFTER INSERT ON requests BEGIN
+            INSERT INTO requests_fts (rowid, name, phone, message)
+            VALUES (new.id, new.name, new.phone, new.message);
+        END
+    """)
+    await conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS requests_fts_delete AFTER DELETE ON requests BEGIN
+            INSERT INTO requests_fts (requests_fts, rowid, name, phone, message)
+            VALUES ('delete', old.id, old.name, old.phone, old.message);
+        END
+    """)
+    await conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS requests_fts_update
+        AFTER UPDATE OF name, phone, message ON requests BEGIN
+            INSERT INTO requests_fts (requests_fts, rowid, name, phone, message)
+            VALUES ('delete', old.id, old.name, old.phone, old.message);
+            INSERT INTO requests_fts (rowid, name, phone, message)
+            VALUES (new.id, new.name, new.phone, new.message);
+        END
+    """)
+    if not fts_exists:
+        # Веса колонок для ранжирования: имя важнее телефона, телефон — текста
+        await conn.execute(
+            "INSERT INTO requests_fts (requests_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 1.0)')"
+        )
+        logger.info("Заполняем полнотекстовый индекс по существующим заявкам")
+        await conn.execute("INSERT INTO requests_fts (requests_fts) VALUES ('rebuild')")
+
+@migration(5, "журнал событий админки")
+async def migrate_admin_events(conn: aiosqlite.Connection):
+    # Журнал событий для ленты админки (SSE) с возобновлением по id
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS admin_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL,
+            request_id INTEGER,
+            payload TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+
+@migration(6, "идемпотентность заявок")
+async def migrate_request_source(conn: aiosqlite.Connection):
+    # Сообщение, с которого начата анкета: ключ идемпотентности заявки
+    if 'source_message_id' not in await table_columns(conn, 'requests'):
+        await conn.execute("ALTER TABLE requests ADD COLUMN source_message_id INTEGER")
+    await conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_requests_source ON requests(user_id, source_message_id)"
+    )
+
+@migration(7, "архив документов")
+async def migrate_document_storage(conn: aiosqlite.Connection):
+    # Ключ содержимого в хранилище и очередь на скачивание
+    if 'storage_key' not in await table_columns(conn, 'documents'):
+        await conn.execute("ALTER TABLE documents ADD COLUMN storage_key TEXT")
+        await conn.execute("ALTER TABLE documents ADD COLUMN archive_attempts INTEGER NOT NULL DEFAULT 0")
+        await conn.execute("ALTER TABLE documents ADD COLUMN archive_after REAL NOT NULL DEFAULT 0")
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_documents_unarchived
+        ON documents(archive_after) WHERE storage_key IS NULL
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_file_id ON documents(file_id)")
+
+@migration(8, "позиция уведомлений администраторов")
+async def migrate_notifier_state(conn: aiosqlite.Connection):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS notifier_state (
+            name TEXT PRIMARY KEY,
+            last_event_id INTEGER NOT NULL,
+            last_sent_at REAL NOT NULL DEFAULT 0
+        )
+    """)
+    # При первом запуске история не рассылается
+    await conn.execute("""
+        INSERT OR IGNORE INTO notifier_state (name, last_event_id)
+        SELECT 'admin_chat', COALESCE(MAX(id), 0) FROM admin_events
+    """)
+
+@migration(9, "вложения черновиков анкет")
+async def migrate_draft_attachments(conn: aiosqlite.Connection):
+    # Вложения анкеты хранятся отдельно от данных FSM: строки только добавляются
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS draft_attachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            draft_id INTEGER NOT NULL,
+            file_unique_id TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            UNIQUE (user_id, draft_id, file_unique_id)
+        )
+    """)
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_draft_attachments_user_created ON draft_attachments(user_id, created_at)"
+    )
+
+@migration(10, "сводная статистика заявок")
+async def migrate_request_stats(conn: aiosqlite.Connection):
+    # Счетчики для /admin/api/stats ведут триггеры: панель читает O(дней), а не O(заявок).
+    # stats_status — заявки рабочей базы по статусам (архивация их уменьшает),
+    # stats_daily — поступление и завершение по дням UTC за все время
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_status (
+            status TEXT PRIMARY KEY,
+            requests INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            created INTEGER NOT NULL DEFAULT 0,
+            resolved INTEGER NOT NULL DEFAULT 0,
+            resolution_seconds REAL NOT NULL DEFAULT 0
+        )
+    """)
+    # История статусов; первая запись заявки (old_status IS NULL) хранит время создания
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS request_status_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id INTEGER NOT NULL,
+            old_status TEXT,
+            new_status TEXT,
+            changed_at TEXT NOT NULL
+        )
+    """)
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_status_history_request ON request_status_history(request_id, id)"
+    )
+    await conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS stats_requests_insert AFTER INSERT ON requests BEGIN
+            INSERT INTO stats_status (status, requests) VALUES (COALESCE(new.status, 'new'), 1)
+            ON CONFLICT(status) DO UPDATE SET requests = requests + 1;
+            INSERT INTO stats_daily (day, created) VALUES (substr(new.created_at, 1, 10), 1)
+            ON CONFLICT(day) DO UPDATE SET created = created + 1;
+            INSERT INTO request_status_history (request_id, old_status, new_status, changed_at)
+            VALUES (new.id, NULL, new.status, new.created_at);
+        END
+    """)
+    await conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS stats_requests_status
+        AFTER UPDATE OF status ON requests WHEN new.status IS NOT old.status BEGIN
+            UPDATE stats_status SET requests = requests - 1 WHERE status = COALESCE(old.status, 'new');
+            INSERT INTO stats_status (status, requests) VALUES (COALESCE(new.status, 'new'), 1)
+            ON CONFLICT(status) DO UPDATE SET requests = requests + 1;
+            INSERT INTO request_status_history (request_id, old_status, new_status, changed_at)
+            VALUES (new.id, old.status, new.status, strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'));
+            INSERT INTO stats_daily (day, resolved, resolution_seconds)
+            SELECT date('now'), 1, (julianday('now') - julianday(new.created_at)) * 86400
+            WHERE new.status = 'done'
+            ON CONFLICT(day) DO UPDATE SET
+                resolved = resolved + 1,
+                resolution_seconds = resolution_seconds + excluded.resolution_seconds;
+        END
+    """)
+    await conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS stats_requests_delete AFTER DELETE ON requests BEGIN
+            UPDATE stats_status SET requests = requests - 1 WHERE status = COALESCE(old.status, 'new');
+        END
+    """)
+    await rebuild_stats_tables(conn)
+
+@migration(11, "аренда рассылки администраторам")
+async def migrate_notifier_lease(conn: aiosqlite.Connection):
+    # Позиция сдвигается только после отправки; пока идет рассылка, ее держит один процесс
+    if 'lease_until' not in await table_columns(conn, 'notifier_state'):
+        await conn.execute("ALTER TABLE notifier_state ADD COLUMN lease_until REAL NOT NULL DEFAULT 0")
 
-        async with aiosqlite.connect('bot.db') as db:
-            # Включаем доступ к полям по именам
-            db.row_factory = aiosqlite.Row
-
-            # Создаем таблицу requests, если не существует
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS requests (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    name TEXT,
-                    phone TEXT,
-                    message TEXT,
-                    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                    status TEXT DEFAULT 'new'
+async def schema_version(conn: aiosqlite.Connection) -> int:
+    try:
+        rows = await conn.execute_fetchall("SELECT MAX(version) FROM schema_version")
+    except sqlite3.OperationalError:
+        return 0
+    return rows[0][0] or 0
+
+async def init_db():
+    # Актуальная схема проверяется одним чтением, без блокировки записи
+    latest = MIGRATIONS[-1][0]
+    async with db.read('schema_version') as conn:
+        current = await schema_version(conn)
+    if current == latest:
+        return
+
+    logger.info(f"Обновление схемы базы данных: версия {current} -> {latest}")
+    try:
+        async with db.write('migration') as conn:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TEXT NOT NULL
                 )
             """)
+        for version, name, apply in MIGRATIONS:
+            async with db.write('migration') as conn:
+                # Версию перечитываем под блокировкой: ее мог уже поднять соседний воркер
+                if version <= await schema_version(conn):
+                    continue
+                logger.info(f"Миграция {version}: {name}")
+                await apply(conn)
+                await conn.execute(
+                    "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                    (version, name, utc_now())
+                )
+        logger.info("Схема базы данных обновлена")
 
-            # Проверяем существование колонки user_id
-            cursor = await db.execute("PRAGMA table_info(requests)")
-            columns = await cursor.fetchall()
-            column_names = [col['name'] for col in columns]  # Используем именованный доступ
-            
-            if 'user_id' not in column_names:
-                logger.info("Добавляем колонку user_id в таблицу requests")
-                await db.execute("ALTER TABLE requests ADD COLUMN user_id INTEGER")
-                logger.info("Колонка user_id успешно добавлена")
-
-            # Создаем таблицу documents, если не существует
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS documents (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    request_id INTEGER,
-                    file_id TEXT NOT NULL,
-                    file_name TEXT NOT NULL,
-                    file_type TEXT NOT NULL,
-                    file_size INTEGER NOT NULL,
-                    sent_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (request_id) REFERENCES requests(id) ON DELETE CASCADE
+    except Exception as e:
+        logger.error(f"Критическая ошибка при миграции базы данных: {str(e)}")
+        raise RuntimeError(f"Ошибка инициализации БД: {str(e)}") from e
+
+# ===== СОБЫТИЯ ДЛЯ АДМИНКИ =====
+SSE_HEARTBEAT = 15.0
+SSE_BATCH_SIZE = 100
+
+def utc_now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+# Пробуждение подписчиков ленты в этом процессе. События других воркеров
+# подхватываются при ближайшем heartbeat-запросе к admin_events.
+class AdminEvents:
+    def __init__(self):
+        self._changed: Optional[asyncio.Event] = None
+
+    def snapshot(self) -> asyncio.Event:
+        # Берется до чтения admin_events: notify() во время чтения выставит именно его
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    def notify(self):
+        changed = self.snapshot()
+        self._changed = asyncio.Event()
+        changed.set()
+
+    @staticmethod
+    async def wait(changed: asyncio.Event, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+admin_events = AdminEvents()
+
+async def publish_event(conn: aiosqlite.Connection, event_type: str, request_id: int, payload: dict):
+    # Пишется в транзакции вызывающего; подписчиков будит admin_events.notify() после commit
+    await conn.execute(
+        "INSERT INTO admin_events (type, request_id, payload, created_at) VALUES (?, ?, ?, ?)",
+        (event_type, request_id, json.dumps(payload, ensure_ascii=False), utc_now())
+    )
+
+# ===== ЗАПИСЬ ЗАЯВОК =====
+# WRITE_BEHIND=1: заявка пишется фоновым писателем пачками, а пользователь
+# получает ответ, не дожидаясь коммита
+WRITE_BEHIND = os.getenv('WRITE_BEHIND') == '1'
+REQUEST_WRITE_BATCH = 100
+
+def build_request_record(user_id: int, data: Dict[str, Any], source_message_id: int) -> dict:
+    # Все значения готовятся до захвата соединения-писателя
+    return {
+        "user_id": user_id,
+        "name": data['name'],
+        "phone": data['phone'],
+        "message": data['message_text'],
+        "created_at": utc_now(),
+        "source_message_id": source_message_id,
+        "docs": data.get('docs', []),
+    }
+
+async def save_request(conn: aiosqlite.Connection, record: dict) -> Optional[int]:
+    # Повторный /done по той же анкете не создает вторую заявку
+    cursor = await conn.execute(
+        """INSERT INTO requests 
+        (user_id, name, phone, message, created_at, source_message_id) 
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, source_message_id) DO NOTHING
+        RETURNING id""",
+        (record["user_id"], record["name"], record["phone"], record["message"],
+         record["created_at"], record["source_message_id"])
+    )
+    row = await cursor.fetchone()
+    await cursor.close()
+    if row is None:
+        logger.info(f"Заявка по анкете {record['source_message_id']} пользователя {record['user_id']} уже сохранена")
+        return None
+    request_id = row[0]
+
+    docs = record["docs"]
+    if docs:
+        await conn.executemany(
+            """INSERT INTO documents 
+            (request_id, file_id, file_name, file_type, file_size, sent_at) 
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            [(request_id, doc['file_id'], doc['file_name'], doc['file_type'],
+              doc['file_size'], record["created_at"]) for doc in docs]
+        )
+
+    await publish_event(conn, "request_created", request_id, {
+        "id": request_id,
+        "user_id": record["user_id"],
+        "name": record["name"],
+        "phone": record["phone"],
+        "message": shorten_message(record["message"]),
+        "created_at": record["created_at"],
+        "status": "new",
+        "documents": [{"request_id": request_id, **doc} for doc in docs]
+    })
+    return request_id
+
+def requests_committed():
+    # После commit новых заявок будим всех, кто их разбирает
+    admin_events.notify()
+    archiver.wake()
+    admin_notifier.wake()
+
+# Фоновый писатель заявок: пачка заявок коммитится одной транзакцией
+class RequestWriter:
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def submit(self, record: dict):
+        self._queue.put_nowait(record)
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty() and len(batch) < REQUEST_WRITE_BATCH:
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _write(self, batch: List[dict]):
+        try:
+            async with db.write('save_request_batch') as conn:
+                for record in batch:
+                    await save_request(conn, record)
+        except Exception as e:
+            # Пачка откатилась целиком: пишем по одной, чтобы не потерять остальные
+            logger.error(f"Ошибка пакетной записи заявок: {e}")
+            for record in batch:
+                try:
+                    async with db.write('save_request') as conn:
+                        await save_request(conn, record)
+                except Exception as e:
+                    logger.error(f"Заявка пользователя {record['user_id']} не сохранена: {e}")
+        requests_committed()
+
+request_writer = RequestWriter()
+
+# ===== ВЛОЖЕНИЯ АНКЕТЫ =====
+# Документы черновика пишутся в draft_attachments, а не в данные FSM: список не копируется
+# при каждом get_data/update_data. Лимиты проверяются в той же транзакции, что и запись,
+# поэтому их не обойти параллельными сообщениями. Повторно присланный файл (тот же
+# file_unique_id) в черновике не дублируется
+UPLOAD_MAX_FILES = int(os.getenv('UPLOAD_MAX_FILES', '20'))  # на одну заявку
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(100 * 1024 * 1024)))
+UPLOAD_USER_MAX_FILES = int(os.getenv('UPLOAD_USER_MAX_FILES', '100'))  # на пользователя за окно
+UPLOAD_USER_MAX_BYTES = int(os.getenv('UPLOAD_USER_MAX_BYTES', str(500 * 1024 * 1024)))
+UPLOAD_USER_WINDOW = float(os.getenv('UPLOAD_USER_WINDOW', str(24 * 3600)))
+# Альбом приходит отдельными сообщениями с общим media_group_id: ждем тишину и разбираем разом
+ALBUM_WAIT = float(os.getenv('ALBUM_WAIT', '0.5'))
+
+UPLOADS = Counter('legalbot_uploads_total', 'Документы, присланные в анкету', ['result'])
+
+def document_error(document: types.Document) -> Optional[str]:
+    # Проверки по метаданным сообщения, до обращения к базе
+    if document.mime_type not in ALLOWED_DOCUMENT_TYPES:
+        return 'doc_type_error'
+    if (document.file_size or 0) > MAX_DOCUMENT_SIZE:
+        return 'doc_size_error'
+    return None
+
+def document_record(document: types.Document) -> dict:
+    return {
+        'file_unique_id': document.file_unique_id,
+        'file_id': document.file_id,
+        'file_name': document.file_name or document.file_unique_id,
+        'file_type': document.mime_type,
+        'file_size': document.file_size or 0,
+    }
+
+def attachments_reply(lang: str, added: int, errors: List[str]) -> str:
+    t = translations[lang]
+    lines = [t['doc_added'] if added == 1 else t['docs_added'].format(count=added)] if added else []
+    # Каждая причина отказа упоминается один раз, даже если отклонена половина альбома
+    lines += [t[error] for error in dict.fromkeys(errors)]
+    return "\n".join(lines)
+
+class DraftAttachments:
+    def __init__(self):
+        self._albums: Dict[Tuple[int, str], dict] = {}
+        # Задачи альбомов по чатам: живут, пока файлы не сохранены и ответ не отправлен
+        self._flushing: Dict[asyncio.Task, int] = {}
+
+    async def add(self, user_id: int, draft_id: int, files: List[dict]) -> Tuple[int, List[str]]:
+        # Возвращает число добавленных файлов и причины отказа для остальных
+        since = (datetime.now(timezone.utc) - timedelta(seconds=UPLOAD_USER_WINDOW)).isoformat()
+        created_at = utc_now()
+        added, errors = [], []
+        async with db.write('draft_attach') as conn:
+            existing = await conn.execute_fetchall(
+                "SELECT file_unique_id, file_size FROM draft_attachments WHERE user_id = ? AND draft_id = ?",
+                (user_id, draft_id)
+            )
+            seen = {row['file_unique_id'] for row in existing}
+            draft_files, draft_bytes = len(existing), sum(row['file_size'] for row in existing)
+            user_files, user_bytes = (await conn.execute_fetchall(
+                """SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM draft_attachments
+                   WHERE user_id = ? AND created_at >= ?""",
+                (user_id, since)
+            ))[0]
+            for file in files:
+                size = file['file_size']
+                if file['file_unique_id'] in seen:
+                    errors.append('doc_duplicate')
+                elif draft_files >= UPLOAD_MAX_FILES or draft_bytes + size > UPLOAD_MAX_BYTES:
+                    errors.append('doc_limit_error')
+                elif user_files >= UPLOAD_USER_MAX_FILES or user_bytes + size > UPLOAD_USER_MAX_BYTES:
+                    errors.append('doc_user_limit_error')
+                else:
+                    seen.add(file['file_unique_id'])
+                    draft_files, draft_bytes = draft_files + 1, draft_bytes + size
+                    user_files, user_bytes = user_files + 1, user_bytes + size
+                    added.append(file)
+            if added:
+                await conn.executemany(
+                    """INSERT OR IGNORE INTO draft_attachments
+                    (user_id, draft_id, file_unique_id, file_id, file_name, file_type, file_size, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    [(user_id, draft_id, f['file_unique_id'], f['file_id'], f['file_name'],
+                      f['file_type'], f['file_size'], created_at) for f in added]
                 )
-            """)
+        UPLOADS.labels('added').inc(len(added))
+        for error in errors:
+            UPLOADS.labels(error).inc()
+        return len(added), errors
 
-            # Создаем индекс для улучшения производительности
-            await db.execute("""
-                CREATE INDEX IF NOT EXISTS idx_documents_request_id 
-                ON documents(request_id)
-            """)
+    async def files(self, user_id: int, draft_id: int) -> List[dict]:
+        async with db.read('draft_attachments') as conn:
+            rows = await conn.execute_fetchall(
+                """SELECT file_id, file_name, file_type, file_size FROM draft_attachments
+                   WHERE user_id = ? AND draft_id = ? ORDER BY id""",
+                (user_id, draft_id)
+            )
+        return [dict(row) for row in rows]
 
-            # Проверяем список таблиц для отладки
-            cursor = await db.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = await cursor.fetchall()
-            logger.info(f"Существующие таблицы: {[t['name'] for t in tables]}")
+    def collect_album(self, message: types.Message, draft_id: int, lang: str):
+        # Обработчик только складывает сообщение: разбор идет после паузы, вне блокировки FSM,
+        # иначе следующие части альбома ждали бы окончания этого обработчика
+        key = (message.chat.id, message.media_group_id)
+        album = self._albums.get(key)
+        if album is None:
+            album = self._albums[key] = {
+                "user_id": message.from_user.id,
+                "draft_id": draft_id,
+                "lang": lang,
+                "messages": [],
+            }
+            album["task"] = task = asyncio.create_task(self._flush_album(key))
+            self._flushing[task] = key[0]
+            task.add_done_callback(self._flushing.pop)
+        album["messages"].append(message)
+        album["deadline"] = time.monotonic() + ALBUM_WAIT
+
+    async def _flush_album(self, key: Tuple[int, str]):
+        album = self._albums[key]
+        while (delay := album["deadline"] - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        del self._albums[key]
+        messages = sorted(album["messages"], key=lambda m: m.message_id)
+        files, errors = [], []
+        for message in messages:
+            error = document_error(message.document)
+            if error:
+                UPLOADS.labels(error).inc()
+                errors.append(error)
+            else:
+                files.append(document_record(message.document))
+        try:
+            added = 0
+            if files:
+                added, rejected = await self.add(album["user_id"], album["draft_id"], files)
+                errors += rejected
+            await messages[0].answer(attachments_reply(album["lang"], added, errors))
+        except Exception as e:
+            logger.error(f"Ошибка обработки альбома {key[1]} в чате {key[0]}: {e}")
 
-            # Проверяем структуру таблицы requests для отладки
-            cursor = await db.execute("PRAGMA table_info(requests)")
-            columns = await cursor.fetchall()
-            logger.info("Структура таблицы requests:")
-            for col in columns:
-                logger.info(f"  {col['name']}: {col['type']}")
+    async def settle(self, chat_id: int):
+        # /done дожидается альбомов этого чата, чтобы их документы попали в заявку
+        # Альбом уже снят с приема частей, но его файлы могут еще ждать блокировку записи
+        tasks = [task for task, chat in self._flushing.items() if chat == chat_id]
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-            await db.commit()
-            logger.info("База данных успешно инициализирована")
+    async def stop(self):
+        await asyncio.gather(*list(self._flushing), return_exceptions=True)
 
-    except Exception as e:
-        logger.error(f"Критическая ошибка при инициализации базы данных: {str(e)}")
-        raise RuntimeError(f"Ошибка инициализации БД: {str(e)}") from e
+draft_attachments = DraftAttachments()
 
 # ===== ПЕРЕВОДЫ =====
-translations = {
-    'ru': {
-        'start': '👋 Привет! Я LegalBot. Выберите язык:\n🇷🇺 Русский\n🇬🇧 English',
-        'canceled': '❌ Запрос отменен',
-        'thanks': '✅ Спасибо! Ваша заявка принята',
-        'error_missing_data': '⚠️ Заполните все поля',
-        'contacts': '📞 Контакты: +123456789',
-        'menu': 'Главное меню',
-        'doc_type_error': '⚠️ Неподдерживаемый тип файла',
-        'doc_size_error': '⚠️ Файл слишком большой (максимум 20 МБ)',
-        'back': '◀️ Назад',
-        'faq': '❓ FAQ',
-        'admin_panel': '👤 Админ-панель',
-        'consultation': '📝 Записаться на консультацию',
-        'change_language': '🌐 Сменить язык'
-    },
-    'en': {
-        'start': '👋 Hello! I am LegalBot. Choose language:\n🇬🇧 English\n🇷🇺 Русский',
-        'canceled': '❌ Request canceled',
-        'thanks': '✅ Thank you! Request accepted',
-        'error_missing_data': '⚠️ Please fill all fields',
-        'contacts': '📞 Contacts: +88005553535',
-        'menu': 'Main menu',
-        'doc_type_error': '⚠️ Unsupported file type',
-        'doc_size_error': '⚠️ File too large (max 20 MB)',
-        'back': '◀️ Back',
-        'faq': '❓ FAQ',
-        'admin_panel': '👤 Admin Panel',
-        'consultation': '📝 Book Consultation',
-        'change_language': '🌐 Change Language'
-    }
-}
+# Каталоги лежат в locales/<язык>.json: новый язык добавляется файлом, без правки кода
+LOCALES_DIR = os.getenv('LOCALES_DIR', 'locales')
+DEFAULT_LANG = 'ru'
+
+def load_translations(path: str) -> Dict[str, Dict[str, str]]:
+    catalogs = {}
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.json'):
+            with open(os.path.join(path, name), encoding='utf-8') as f:
+                catalogs[name[:-len('.json')]] = json.load(f)
+    if DEFAULT_LANG not in catalogs:
+        raise ValueError(f"Нет каталога {DEFAULT_LANG}.json в {path}")
+
+    base = catalogs[DEFAULT_LANG]
+    for lang, t in catalogs.items():
+        missing = base.keys() - t.keys()
+        if missing:
+            logger.warning(f"В каталоге {lang} нет ключей {sorted(missing)}, берем из {DEFAULT_LANG}")
+            catalogs[lang] = {**base, **t}
+    # Язык по умолчанию идет первым — в этом порядке строится выбор языка
+    return {lang: catalogs[lang] for lang in sorted(catalogs, key=lambda lang: (lang != DEFAULT_LANG, lang))}
+
+translations = load_translations(LOCALES_DIR)
 
 # ===== СОСТОЯНИЯ =====
 class RequestForm(StatesGroup):
@@ -189,8 +1361,15 @@ async def get_lang(state: FSMContext) -> str:
     data = await state.get_data()
     return data.get('lang', 'ru')
 
-def get_menu(lang: str) -> ReplyKeyboardMarkup:
-    t = translations[lang]
+# ===== КЛАВИАТУРЫ =====
+# Клавиатуры собираются один раз на язык и дальше не меняются; их JSON кэширует сессия бота
+FROZEN_KEYBOARDS: Dict[int, ReplyKeyboardMarkup] = {}
+
+def freeze_keyboard(markup: ReplyKeyboardMarkup) -> ReplyKeyboardMarkup:
+    FROZEN_KEYBOARDS[id(markup)] = markup
+    return markup
+
+def build_menu(t: Dict[str, str]) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text=t['consultation'])],
@@ -201,14 +1380,43 @@ def get_menu(lang: str) -> ReplyKeyboardMarkup:
         resize_keyboard=True
     )
 
+MENU_KEYBOARDS = {lang: freeze_keyboard(build_menu(t)) for lang, t in translations.items()}
+LANGUAGE_KEYBOARD = freeze_keyboard(ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text=t['language_button']) for t in translations.values()],
+        [KeyboardButton(text=translations[DEFAULT_LANG]['back'])]
+    ],
+    resize_keyboard=True
+))
+LANGUAGE_PROMPT = '🌐 Выберите язык / Choose language:\n' + '\n'.join(
+    t['language_button'] for t in translations.values()
+)
+
+def get_menu(lang: str) -> ReplyKeyboardMarkup:
+    return MENU_KEYBOARDS.get(lang) or MENU_KEYBOARDS[DEFAULT_LANG]
+
+# ===== МАРШРУТИЗАЦИЯ КНОПОК =====
+# Таблица «точный текст кнопки -> (действие, язык)» строится один раз из translations,
+# так что разбор нажатия — один поиск в словаре при любом числе языков и кнопок
+MENU_BUTTONS = ('back', 'change_language', 'faq', 'admin_panel', 'consultation')
+
+def build_button_routes() -> Dict[str, Tuple[str, str]]:
+    routes = {}
+    for lang, t in translations.items():
+        for action in MENU_BUTTONS:
+            routes[t[action]] = (action, lang)
+        routes[t['language_button']] = ('language', lang)
+    return routes
+
+BUTTON_ROUTES = build_button_routes()
+
 # ===== ОБРАБОТЧИКИ СООБЩЕНИЙ =====
 @dp.message(Command("start"))
 async def start_handler(message: types.Message, state: FSMContext):
-    await state.clear()
-    await state.update_data(lang='ru')
+    await state.set_state(None)
+    await state.set_data({'lang': 'ru'})
     await message.answer(translations['ru']['start'], reply_markup=get_menu('ru'))
 
-@dp.message(F.text.endswith('Назад') | F.text.endswith('Back'))
 async def back_handler(message: types.Message, state: FSMContext):
     lang = await get_lang(state)
     current_state = await state.get_state()
@@ -225,26 +1433,14 @@ async def back_handler(message: types.Message, state: FSMContext):
             reply_markup=get_menu(lang)
         )
 
-@dp.message(F.text.endswith('Сменить язык') | F.text.endswith('Change Language'))
 async def change_language_handler(message: types.Message, state: FSMContext):
-    await message.answer(
-        '🌐 Выберите язык / Choose language:\n🇷🇺 Русский\n🇬🇧 English',
-        reply_markup=ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="🇷🇺 Русский"), KeyboardButton(text="🇬🇧 English")],
-                [KeyboardButton(text="◀️ Назад")]
-            ],
-            resize_keyboard=True
-        )
-    )
+    await message.answer(LANGUAGE_PROMPT, reply_markup=LANGUAGE_KEYBOARD)
 
-@dp.message(F.text.startswith('🇷🇺') | F.text.startswith('🇬🇧'))
 async def lang_handler(message: types.Message, state: FSMContext):
-    lang = 'ru' if message.text.startswith('🇷🇺') else 'en'
+    lang = BUTTON_ROUTES[message.text][1]
     await state.update_data(lang=lang)
     await message.answer(translations[lang]['menu'], reply_markup=get_menu(lang))
 
-@dp.message(F.text.endswith('FAQ'))
 async def faq_handler(message: types.Message, state: FSMContext):
     lang = await get_lang(state)
     await message.answer(
@@ -252,10 +1448,9 @@ async def faq_handler(message: types.Message, state: FSMContext):
         reply_markup=get_menu(lang)
     )
 
-@dp.message(F.text.endswith('Админ-панель') | F.text.endswith('Admin Panel'))
 async def admin_panel_handler(message: types.Message, state: FSMContext):
     lang = await get_lang(state)
-    admin_url = os.getenv('ADMIN_PANEL_URL', 'https://web-production-bb98.up.railway.app/admin')
+    admin_url = ADMIN_PANEL_URL
     
     await message.answer(
         f"🔐 {translations[lang]['admin_panel']}\n\n{admin_url}",
@@ -268,115 +1463,924 @@ async def cancel_handler(message: types.Message, state: FSMContext):
     await state.clear()
     await message.answer(translations[lang]['canceled'], reply_markup=get_menu(lang))
 
-@dp.message(F.text.endswith('консультацию') | F.text.endswith('Consultation'))
 async def request_handler(message: types.Message, state: FSMContext):
-    await state.set_state(RequestForm.waiting_for_name)
+    await advance(state, RequestForm.waiting_for_name, draft_id=message.message_id)
     await message.answer("Введите ваше имя:", reply_markup=ReplyKeyboardRemove())
 
-@dp.message(RequestForm.waiting_for_name)
+MENU_ACTIONS = {
+    'back': back_handler,
+    'change_language': change_language_handler,
+    'language': lang_handler,
+    'faq': faq_handler,
+    'admin_panel': admin_panel_handler,
+    'consultation': request_handler,
+}
+
+# Единственный обработчик кнопок меню вместо цепочки фильтров endswith/startswith
+@menu_router.message(F.text.in_(BUTTON_ROUTES))
+async def menu_handler(message: types.Message, state: FSMContext):
+    action, _ = BUTTON_ROUTES[message.text]
+    await MENU_ACTIONS[action](message, state)
+
+@router.message(RequestForm.waiting_for_name)
 async def name_handler(message: types.Message, state: FSMContext):
     if not message.text or len(message.text) < 2:
         lang = await get_lang(state)
         await message.answer(translations[lang]['error_missing_data'])
         return
-    await state.update_data(name=message.text)
-    await state.set_state(RequestForm.waiting_for_phone)
+    await advance(state, RequestForm.waiting_for_phone, name=message.text)
     await message.answer("Введите ваш телефон:")
 
-@dp.message(RequestForm.waiting_for_phone)
+@router.message(RequestForm.waiting_for_phone)
 async def phone_handler(message: types.Message, state: FSMContext):
     if not message.text or len(message.text) < 5:
         lang = await get_lang(state)
         await message.answer(translations[lang]['error_missing_data'])
         return
-    await state.update_data(phone=message.text)
-    await state.set_state(RequestForm.waiting_for_message)
+    await advance(state, RequestForm.waiting_for_message, phone=message.text)
     await message.answer("Опишите вашу проблему:")
 
-@dp.message(RequestForm.waiting_for_message)
+@router.message(RequestForm.waiting_for_message)
 async def message_handler(message: types.Message, state: FSMContext):
     if not message.text or len(message.text) < 10:
         lang = await get_lang(state)
         await message.answer(translations[lang]['error_missing_data'])
         return
-    await state.update_data(message_text=message.text)
-    await state.set_state(RequestForm.attach_docs)
+    await advance(state, RequestForm.attach_docs, message_text=message.text)
     await message.answer("Прикрепите документы (если есть) и нажмите /done")
 
 @router.message(StateFilter(RequestForm.attach_docs), F.document)
 async def doc_handler(message: types.Message, state: FSMContext):
-    lang = await get_lang(state)
+    data = await state.get_data()
+    lang = data.get('lang', 'ru')
+    draft_id = data.get('draft_id', 0)
+    logger.debug(f"Документ {message.document.file_unique_id} от {message.from_user.id}: "
+                 f"{message.document.mime_type}, {message.document.file_size} байт")
 
-    logger.info(f"[📎 ДОКУМЕНТ ПОЛУЧЕН] file_id: {message.document.file_id}")
-    logger.info(f"Название: {message.document.file_name}")
-    logger.info(f"Тип: {message.document.mime_type}")
-    logger.info(f"Размер: {message.document.file_size}")
+    if message.media_group_id:
+        draft_attachments.collect_album(message, draft_id, lang)
+        return
 
-    if message.document.mime_type not in ALLOWED_DOCUMENT_TYPES:
-        await message.answer(translations[lang]['doc_type_error'])
+    error = document_error(message.document)
+    if error:
+        UPLOADS.labels(error).inc()
+        await message.answer(translations[lang][error])
         return
 
-    if message.document.file_size > MAX_DOCUMENT_SIZE:
-        await message.answer(translations[lang]['doc_size_error'])
-        return
+    added, errors = await draft_attachments.add(
+        message.from_user.id, draft_id, [document_record(message.document)]
+    )
+    await message.answer(attachments_reply(lang, added, errors))
+
+@dp.message(Command("done"), RequestForm.attach_docs)
+async def finish_handler(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    lang = data.get('lang', 'ru')
+    
+    if not all(k in data for k in ['name', 'phone', 'message_text']):
+        await message.answer(translations[lang]['error_missing_data'])
+        return
+
+    await draft_attachments.settle(message.chat.id)
+    docs = await draft_attachments.files(message.from_user.id, data.get('draft_id', 0))
+    record = build_request_record(
+        message.from_user.id, {**data, 'docs': docs}, data.get('draft_id', message.message_id)
+    )
+    if WRITE_BEHIND:
+        request_writer.submit(record)
+    else:
+        async with db.write('save_request') as conn:
+            await save_request(conn, record)
+        requests_committed()
+    FORM_STEPS.labels('done').inc()
+    
+    await message.answer(translations[lang]['thanks'], reply_markup=get_menu(lang))
+    await state.clear()
+
+# ===== ОЧЕРЕДЬ ВХОДЯЩИХ ОБНОВЛЕНИЙ =====
+WEBHOOK_MODE = os.getenv('WEBHOOK_MODE', 'queue')  # queue | inline
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv('WEBHOOK_ENQUEUE_TIMEOUT', '1.0'))
+WEBHOOK_DEDUP_SIZE = 10000
+WEBHOOK_LATENCY_WINDOW = 1000
+
+def update_chat_key(update: types.Update) -> int:
+    # Ключ для сохранения порядка: чат, иначе отправитель события
+    try:
+        event = update.event
+    except Exception:
+        return 0
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, 'from_user', None)
+    return user.id if user is not None else 0
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+# Ограниченная очередь обновлений с пулом воркеров.
+# Каждый воркер обслуживает свой шард, поэтому обновления одного чата
+# обрабатываются строго по порядку, а разные чаты — параллельно.
+class UpdateQueue:
+    def __init__(self, workers: int = WEBHOOK_WORKERS, maxsize: int = WEBHOOK_QUEUE_SIZE):
+        self.workers = max(1, workers)
+        self.maxsize = maxsize
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.duplicates = 0
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._seen: OrderedDict = OrderedDict()
+        self._latency: deque = deque(maxlen=WEBHOOK_LATENCY_WINDOW)
+
+    def start(self):
+        shard_size = max(1, self.maxsize // self.workers)
+        self._queues = [asyncio.Queue(maxsize=shard_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+        logger.info(f"Очередь обновлений запущена: воркеров {self.workers}, емкость {self.maxsize}")
+
+    async def stop(self, timeout: float = 10.0):
+        # Даем воркерам дообработать уже принятые обновления
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Очередь не опустела при остановке, осталось: {self.depth()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks) and not any(task.done() for task in self._tasks)
+
+    def _remember(self, update_id: int) -> bool:
+        if update_id in self._seen:
+            return False
+        self._seen[update_id] = None
+        if len(self._seen) > WEBHOOK_DEDUP_SIZE:
+            self._seen.popitem(last=False)
+        return True
+
+    async def put(self, update: types.Update) -> bool:
+        if not self._remember(update.update_id):
+            self.duplicates += 1
+            return True
+
+        queue = self._queues[update_chat_key(update) % self.workers]
+        try:
+            await asyncio.wait_for(queue.put((time.monotonic(), update)), WEBHOOK_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Очередь переполнена: отказываем, чтобы Telegram доставил обновление повторно
+            self._seen.pop(update.update_id, None)
+            self.dropped += 1
+            return False
+        return True
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            enqueued_at, update = await queue.get()
+            try:
+                await dp.feed_update(bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                self._latency.append(time.monotonic() - enqueued_at)
+                queue.task_done()
+
+    def stats(self) -> dict:
+        latency = list(self._latency)
+        return {
+            "mode": WEBHOOK_MODE,
+            "workers": self.workers,
+            "queue_depth": self.depth(),
+            "queue_capacity": self.maxsize,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "duplicates": self.duplicates,
+            "latency_ms": {
+                "p50": round(percentile(latency, 0.5) * 1000, 2),
+                "p99": round(percentile(latency, 0.99) * 1000, 2),
+                "max": round(max(latency, default=0.0) * 1000, 2),
+            },
+        }
+
+update_queue = UpdateQueue()
+
+# ===== ИСХОДЯЩИЕ СООБЩЕНИЯ =====
+# Лимиты Telegram: ~30 сообщений в секунду всего и 1 в секунду в один чат.
+# Глобальный лимит делится между воркерами, каждый из которых разбирает outbox.
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '30')) / max(1, WEB_CONCURRENCY)
+OUTBOX_CHAT_INTERVAL = float(os.getenv('OUTBOX_CHAT_INTERVAL', '1.0'))
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_LEASE = 60.0
+OUTBOX_POLL_INTERVAL = 1.0
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_BACKOFF_BASE = 2.0
+OUTBOX_BACKOFF_MAX = 300.0
+OUTBOX_CHAT_IDLE = 60.0
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def delay(self) -> float:
+        # Сколько ждать до следующего токена; 0 — токен выдан
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+async def enqueue_message(conn: aiosqlite.Connection, chat_id: int, text: str, request_id: Optional[int] = None) -> int:
+    cursor = await conn.execute(
+        """INSERT INTO outbox (chat_id, text, request_id, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, ?)""",
+        (chat_id, text, request_id, time.time(), utc_now())
+    )
+    return cursor.lastrowid
+
+# Планировщик исходящих сообщений поверх персистентной очереди outbox в SQLite
+class OutboxScheduler:
+    def __init__(self):
+        self.bucket = TokenBucket(OUTBOX_GLOBAL_RATE)
+        self._chat_ready: OrderedDict = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                claimed = await self._claim()
+                for message in claimed:
+                    await self._deliver(message)
+            except Exception as e:
+                logger.error(f"Ошибка планировщика исходящих сообщений: {e}")
+                claimed = []
+            if len(claimed) < OUTBOX_BATCH_SIZE:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _claim(self) -> list:
+        # Атомарно берем пачку готовых сообщений в аренду; брошенные аренды истекают
+        now = time.time()
+        async with db.write('outbox_claim') as conn:
+            cursor = await conn.execute(
+                """UPDATE outbox SET status = 'sending', next_attempt_at = ?
+                WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at, id
+                    LIMIT ?
+                )
+                RETURNING id, chat_id, text, attempts""",
+                (now + OUTBOX_LEASE, now, OUTBOX_BATCH_SIZE)
+            )
+            return await cursor.fetchall()
+
+    def _chat_delay(self, chat_id: int) -> float:
+        now = time.monotonic()
+        ready_at = self._chat_ready.get(chat_id, 0.0)
+        if ready_at > now:
+            return ready_at - now
+        self._chat_ready[chat_id] = now + OUTBOX_CHAT_INTERVAL
+        self._chat_ready.move_to_end(chat_id)
+        # Забываем чаты, в которые давно ничего не отправляли
+        while self._chat_ready:
+            oldest_chat, oldest_ready = next(iter(self._chat_ready.items()))
+            if oldest_ready > now - OUTBOX_CHAT_IDLE:
+                break
+            self._chat_ready.popitem(last=False)
+        return 0.0
+
+    async def _deliver(self, message):
+        chat_delay = self._chat_delay(message["chat_id"])
+        if chat_delay > 0:
+            # Чат еще на паузе: откладываем без траты попытки
+            await self._finish(message["id"], "pending", message["attempts"], time.time() + chat_delay)
+            return
+
+        delay = self.bucket.delay()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.bucket.delay()
+
+        attempts = message["attempts"] + 1
+        try:
+            await bot.send_message(chat_id=message["chat_id"], text=message["text"])
+        except TelegramRetryAfter as e:
+            self.bucket.pause(e.retry_after)
+            self.retried += 1
+            await self._finish(message["id"], "pending", message["attempts"], time.time() + e.retry_after, str(e))
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Бот заблокирован или чат не существует: повтор не поможет
+            self.failed += 1
+            await self._finish(message["id"], "failed", attempts, None, str(e))
+        except Exception as e:
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                self.failed += 1
+                await self._finish(message["id"], "failed", attempts, None, str(e))
+            else:
+                self.retried += 1
+                backoff = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE ** attempts)
+                await self._finish(message["id"], "pending", attempts, time.time() + backoff, str(e))
+            logger.error(f"Ошибка при отправке сообщения пользователю {message['chat_id']}: {e}")
+        else:
+            self.sent += 1
+            await self._finish(message["id"], "sent", attempts, None)
+
+    async def _finish(self, message_id: int, status: str, attempts: int,
+                      next_attempt_at: Optional[float], error: Optional[str] = None):
+        async with db.write('outbox_finish') as conn:
+            await conn.execute(
+                """UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = COALESCE(?, next_attempt_at),
+                    error = ?, sent_at = CASE WHEN ? = 'sent' THEN ? END
+                WHERE id = ?""",
+                (status, attempts, next_attempt_at, error, status, utc_now(), message_id)
+            )
+
+outbox = OutboxScheduler()
+
+# ===== УВЕДОМЛЕНИЯ АДМИНИСТРАТОРАМ =====
+# Новые заявки читаются из admin_events и уходят в ADMIN_CHAT_ID в фоне, после ответа
+# пользователю. Не чаще одной рассылки за окно: всплеск заявок приходит одной сводкой.
+# Позиция и время последней рассылки общие в базе, поэтому воркеры не дублируют друг друга.
+# Позиция сдвигается после каждой отправленной заявки: сбой Telegram не теряет уведомления,
+# рассылка повторяется с первой неотправленной
+ADMIN_NOTIFY_WINDOW = float(os.getenv('ADMIN_NOTIFY_WINDOW', '60'))
+ADMIN_NOTIFY_POLL = float(os.getenv('ADMIN_NOTIFY_POLL', '30'))
+ADMIN_DIGEST_THRESHOLD = int(os.getenv('ADMIN_DIGEST_THRESHOLD', '3'))
+ADMIN_DIGEST_LINES = 10
+ADMIN_NOTIFY_BATCH = 500
+# Сколько рассылка закреплена за процессом; продлевается после каждой отправки
+ADMIN_NOTIFY_LEASE = 120.0
+MEDIA_GROUP_LIMIT = 10
+
+ADMIN_NOTIFICATIONS = Counter(
+    'legalbot_admin_notifications_total', 'Сообщения в чат администраторов', ['kind']
+)
+
+class AdminNotifier:
+    def __init__(self, chat_id: Optional[str]):
+        self.chat_id = chat_id
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if not self.chat_id:
+            logger.info("ADMIN_CHAT_ID не задан, уведомления администраторам отключены")
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                events, last_id, retry_in = await self._claim()
+                if events:
+                    try:
+                        await self._send(events, last_id)
+                    finally:
+                        await self._release()
+            except Exception as e:
+                logger.error(f"Ошибка уведомления администраторов: {e}")
+                retry_in = ADMIN_NOTIFY_WINDOW
+            if retry_in:
+                # Окно еще открыто или рассылку ведет другой процесс: ждем
+                await asyncio.sleep(retry_in)
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), ADMIN_NOTIFY_POLL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _claim(self) -> Tuple[List[Tuple[int, dict]], int, float]:
+        now = time.time()
+        async with db.write('admin_notify_claim') as conn:
+            rows = await conn.execute_fetchall(
+                "SELECT last_event_id, last_sent_at, lease_until FROM notifier_state WHERE name = 'admin_chat'"
+            )
+            last_event_id, last_sent_at, lease_until = rows[0]
+            if now < lease_until:
+                return [], 0, lease_until - now
+            rows = await conn.execute_fetchall(
+                "SELECT id, type, payload FROM admin_events WHERE id > ? ORDER BY id LIMIT ?",
+                (last_event_id, ADMIN_NOTIFY_BATCH)
+            )
+            if not rows:
+                return [], 0, 0
+            events = [(row['id'], json.loads(row['payload'])) for row in rows if row['type'] == 'request_created']
+            if not events:
+                # Позиция сдвигается и за события других типов, чтобы не читать их снова
+                await conn.execute(
+                    "UPDATE notifier_state SET last_event_id = ? WHERE name = 'admin_chat'", (rows[-1]['id'],)
+                )
+                return [], 0, 0
+            if now < last_sent_at + ADMIN_NOTIFY_WINDOW:
+                return [], 0, last_sent_at + ADMIN_NOTIFY_WINDOW - now
+            await conn.execute(
+                "UPDATE notifier_state SET lease_until = ? WHERE name = 'admin_chat'", (now + ADMIN_NOTIFY_LEASE,)
+            )
+            return events, rows[-1]['id'], 0
+
+    async def _advance(self, event_id: int):
+        now = time.time()
+        async with db.write('admin_notify_advance') as conn:
+            await conn.execute(
+                """UPDATE notifier_state SET last_event_id = MAX(last_event_id, ?), last_sent_at = ?,
+                    lease_until = ? WHERE name = 'admin_chat'""",
+                (event_id, now, now + ADMIN_NOTIFY_LEASE)
+            )
+
+    async def _release(self):
+        async with db.write('admin_notify_release') as conn:
+            await conn.execute("UPDATE notifier_state SET lease_until = 0 WHERE name = 'admin_chat'")
+
+    async def _send(self, events: List[Tuple[int, dict]], last_id: int):
+        # В сводке текст один на всех, но документы каждой заявки все равно уходят альбомами.
+        # Позиция сдвигается после документов заявки: при сбое недоставленные заявки придут снова
+        digest = len(events) > ADMIN_DIGEST_THRESHOLD
+        if digest:
+            await self._call(bot.send_message, self.chat_id, self._digest([event for _, event in events]))
+            ADMIN_NOTIFICATIONS.labels('digest').inc()
+        for event_id, event in events:
+            try:
+                if not digest:
+                    await self._call(bot.send_message, self.chat_id, self._alert(event))
+                    ADMIN_NOTIFICATIONS.labels('alert').inc()
+                await self._send_documents(event)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Повтор не поможет: пропускаем заявку, чтобы она не держала очередь
+                logger.error(f"Уведомление о заявке #{event['id']} не отправлено: {e}")
+                ADMIN_NOTIFICATIONS.labels('failed').inc()
+            await self._advance(event_id)
+        await self._advance(last_id)
+
+    async def _send_documents(self, event: dict):
+        documents = event.get('documents') or []
+        # Документы заявки уходят альбомами по 10 вместо сообщения на каждый файл
+        for start in range(0, len(documents), MEDIA_GROUP_LIMIT):
+            group = documents[start:start + MEDIA_GROUP_LIMIT]
+            caption = f"📎 Документы к заявке #{event['id']}" if start == 0 else None
+            if len(group) == 1:
+                await self._call(bot.send_document, self.chat_id, group[0]['file_id'], caption=caption)
+            else:
+                media = [InputMediaDocument(media=doc['file_id']) for doc in group]
+                media[0] = InputMediaDocument(media=group[0]['file_id'], caption=caption)
+                await self._call(bot.send_media_group, self.chat_id, media)
+            ADMIN_NOTIFICATIONS.labels('documents').inc()
+
+    async def _call(self, method, *args, **kwargs):
+        try:
+            return await method(*args, **kwargs)
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            return await method(*args, **kwargs)
+
+    @staticmethod
+    def _alert(event: dict) -> str:
+        lines = [
+            f"🆕 <b>Новая заявка #{event['id']}</b>",
+            f"👤 {html.escape(event['name'] or '')}",
+            f"📞 {html.escape(event['phone'] or '')}",
+            f"💬 {html.escape(event['message'] or '')}",
+        ]
+        if event.get('documents'):
+            lines.append(f"📎 Документов: {len(event['documents'])}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _digest(events: List[dict]) -> str:
+        first = datetime.fromisoformat(events[0]['created_at'])
+        minutes = max(1, round((datetime.now(timezone.utc) - first).total_seconds() / 60))
+        period = "последнюю минуту" if minutes == 1 else f"последние {minutes} мин."
+        lines = [f"🆕 <b>Новых заявок: {len(events)} за {period}</b>"]
+        for event in events[:ADMIN_DIGEST_LINES]:
+            lines.append(f"#{event['id']} {html.escape(event['name'] or '')} — {html.escape(event['phone'] or '')}")
+        if len(events) > ADMIN_DIGEST_LINES:
+            lines.append(f"…и еще {len(events) - ADMIN_DIGEST_LINES}")
+        if ADMIN_PANEL_URL:
+            lines.append(ADMIN_PANEL_URL)
+        return "\n".join(lines)
+
+admin_notifier = AdminNotifier(ADMIN_CHAT_ID)
+
+# ===== ХРАНЕНИЕ И АРХИВ ЗАЯВОК =====
+# Закрытые и старые заявки переезжают из рабочей базы в помесячные архивные базы
+# RETENTION_DIR/requests-YYYY-MM.db небольшими пачками, чтобы не держать блокировку записи.
+# Сначала пачка фиксируется в архиве, затем удаляется из рабочей базы: сбой между шагами
+# дает только повторное копирование (INSERT OR REPLACE), но не потерю заявок
+RETENTION_DIR = os.getenv('RETENTION_DIR', os.path.join(os.path.dirname(DB_PATH), 'archive'))
+RETENTION_CLOSED_DAYS = int(os.getenv('RETENTION_CLOSED_DAYS', '90'))
+RETENTION_MAX_DAYS = int(os.getenv('RETENTION_MAX_DAYS', '365'))  # 0 — незакрытые не архивируются
+RETENTION_CLOSED_STATUSES = tuple(os.getenv('RETENTION_CLOSED_STATUSES', 'done').split(','))
+RETENTION_EVENTS_DAYS = int(os.getenv('RETENTION_EVENTS_DAYS', '14'))
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '200'))
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', str(6 * 3600)))
+RETENTION_START_DELAY = float(os.getenv('RETENTION_START_DELAY', '300'))
+RETENTION_PAUSE = 0.05  # пауза между пачками, чтобы бот успевал писать
+RETENTION_VACUUM_PAGES = 2000
+RETENTION_LOCK_PATH = f"{DB_PATH}.retention.lock"
+
+ARCHIVE_REQUEST_COLUMNS = "id, user_id, name, phone, message, created_at, status, source_message_id"
+ARCHIVE_DOCUMENT_COLUMNS = "id, request_id, file_id, file_name, file_type, file_size, sent_at, storage_key"
+ARCHIVE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS arc.requests (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        name TEXT,
+        phone TEXT,
+        message TEXT,
+        created_at TEXT,
+        status TEXT,
+        source_message_id INTEGER,
+        archived_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS arc.idx_requests_created ON requests(created_at, id);
+    CREATE TABLE IF NOT EXISTS arc.documents (
+        id INTEGER PRIMARY KEY,
+        request_id INTEGER,
+        file_id TEXT,
+        file_name TEXT,
+        file_type TEXT,
+        file_size INTEGER,
+        sent_at TEXT,
+        storage_key TEXT
+    );
+    CREATE INDEX IF NOT EXISTS arc.idx_documents_request_id ON documents(request_id);
+"""
+
+ARCHIVED_REQUESTS = Counter('legalbot_archived_requests_total', 'Заявки, перенесенные в архивные базы')
+
+def archive_path(month: str) -> str:
+    return os.path.join(RETENTION_DIR, f"requests-{month}.db")
+
+def archive_partitions() -> List[str]:
+    # Месяцы архива от новых к старым
+    if not os.path.isdir(RETENTION_DIR):
+        return []
+    months = [m.group(1) for m in map(re.compile(r"requests-(\d{4}-\d{2})\.db").fullmatch, os.listdir(RETENTION_DIR)) if m]
+    return sorted(months, reverse=True)
+
+class RetentionWorker:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        await asyncio.sleep(RETENTION_START_DELAY)
+        while True:
+            # Одновременно обслуживанием занимается только один воркер
+            with open(RETENTION_LOCK_PATH, 'w') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    pass
+                else:
+                    try:
+                        result = await self.run_once()
+                        logger.info(f"Обслуживание базы: {result}")
+                    except Exception as e:
+                        logger.error(f"Ошибка архивации заявок: {e}")
+            await asyncio.sleep(RETENTION_INTERVAL)
+
+    async def run_once(self) -> Dict[str, int]:
+        os.makedirs(RETENTION_DIR, exist_ok=True)
+        moved = 0
+        conn = await aiosqlite.connect(DB_PATH)
+        conn.row_factory = aiosqlite.Row
+        try:
+            await conn.execute("PRAGMA busy_timeout=5000")
+            while True:
+                batch = await self._select_batch()
+                if not batch:
+                    break
+                months: Dict[str, List] = {}
+                for row in batch:
+                    months.setdefault(row['created_at'][:7], []).append(row['id'])
+                batch_moved = 0
+                for month, ids in months.items():
+                    batch_moved += await self._move(conn, month, ids)
+                moved += batch_moved
+                # Все заявки пачки изменились по ходу переноса: дождемся следующего запуска
+                if not batch_moved:
+                    break
+                await asyncio.sleep(RETENTION_PAUSE)
+        finally:
+            await conn.close()
+        pruned = await self._prune_logs()
+        await self._maintain()
+        return {"moved": moved, "pruned": pruned}
+
+    async def _select_batch(self) -> list:
+        now = datetime.now(timezone.utc)
+        closed_before = (now - timedelta(days=RETENTION_CLOSED_DAYS)).isoformat()
+        any_before = (now - timedelta(days=RETENTION_MAX_DAYS)).isoformat() if RETENTION_MAX_DAYS else ''
+        placeholders = ",".join("?" * len(RETENTION_CLOSED_STATUSES))
+        async with db.read('retention_select') as conn:
+            return await conn.execute_fetchall(
+                f"""SELECT id, created_at FROM requests
+                    WHERE created_at < ? AND (status IN ({placeholders}) OR created_at < ?)
+                    ORDER BY created_at, id LIMIT ?""",
+                (max(closed_before, any_before), *RETENTION_CLOSED_STATUSES, any_before, RETENTION_BATCH_SIZE)
+            )
+
+    async def _move(self, conn: aiosqlite.Connection, month: str, ids: List[int]) -> int:
+        placeholders = ",".join("?" * len(ids))
+        await conn.execute("ATTACH DATABASE ? AS arc", (archive_path(month),))
+        try:
+            await conn.executescript(ARCHIVE_SCHEMA)
+            # Шаг 1: копия в архив фиксируется отдельной транзакцией архивной базы
+            await conn.execute("BEGIN")
+            await conn.execute(
+                f"""INSERT OR REPLACE INTO arc.requests ({ARCHIVE_REQUEST_COLUMNS}, archived_at)
+                    SELECT {ARCHIVE_REQUEST_COLUMNS}, ? FROM main.requests WHERE id IN ({placeholders})""",
+                (utc_now(), *ids)
+            )
+            await conn.execute(
+                f"""INSERT OR REPLACE INTO arc.documents ({ARCHIVE_DOCUMENT_COLUMNS})
+                    SELECT {ARCHIVE_DOCUMENT_COLUMNS} FROM main.documents WHERE request_id IN ({placeholders})""",
+                ids
+            )
+            await conn.commit()
+            copied = await conn.execute_fetchall(
+                f"SELECT id, status FROM arc.requests WHERE id IN ({placeholders})", ids
+            )
+
+            # Шаг 2: удаление из рабочей базы, только если статус не поменялся после копирования
+            async with db.write('retention_delete') as main:
+                cursor = await main.executemany(
+                    "DELETE FROM requests WHERE id = ? AND status IS ?",
+                    [(row['id'], row['status']) for row in copied]
+                )
+                deleted = cursor.rowcount
+                await main.execute(
+                    f"""DELETE FROM documents WHERE request_id IN ({placeholders})
+                        AND request_id NOT IN (SELECT id FROM requests WHERE id IN ({placeholders}))""",
+                    (*ids, *ids)
+                )
+                kept = [row['id'] for row in await main.execute_fetchall(
+                    f"SELECT id FROM requests WHERE id IN ({placeholders})", ids
+                )]
+
+            # Заявки, оставшиеся в работе, не должны дублироваться в архиве
+            if kept:
+                kept_placeholders = ",".join("?" * len(kept))
+                await conn.execute(f"DELETE FROM arc.requests WHERE id IN ({kept_placeholders})", kept)
+                await conn.execute(f"DELETE FROM arc.documents WHERE request_id IN ({kept_placeholders})", kept)
+                await conn.commit()
+        finally:
+            if conn.in_transaction:
+                await conn.rollback()
+            await conn.execute("DETACH DATABASE arc")
+        ARCHIVED_REQUESTS.inc(deleted)
+        return deleted
+
+    async def _prune_logs(self) -> int:
+        # Журнал ленты, отработанные сообщения outbox и вложения черновиков нужны только за последние дни
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=RETENTION_EVENTS_DAYS)).isoformat()
+        pruned = 0
+        for sql in (
+            "DELETE FROM admin_events WHERE id IN "
+            "(SELECT id FROM admin_events WHERE created_at < ? ORDER BY id LIMIT ?)",
+            "DELETE FROM outbox WHERE id IN (SELECT id FROM outbox "
+            "WHERE status IN ('sent', 'failed') AND created_at < ? ORDER BY id LIMIT ?)",
+            "DELETE FROM draft_attachments WHERE id IN "
+            "(SELECT id FROM draft_attachments WHERE created_at < ? ORDER BY id LIMIT ?)",
+        ):
+            while True:
+                async with db.write('retention_prune') as conn:
+                    cursor = await conn.execute(sql, (cutoff, RETENTION_BATCH_SIZE))
+                    deleted = cursor.rowcount
+                pruned += deleted
+                if deleted < RETENTION_BATCH_SIZE:
+                    break
+                await asyncio.sleep(RETENTION_PAUSE)
+        return pruned
+
+    async def _maintain(self):
+        async with db.exclusive() as conn:
+            mode = (await conn.execute_fetchall("PRAGMA auto_vacuum"))[0][0]
+            if mode != 2:
+                # Переход в incremental требует одного полного VACUUM
+                logger.info("Переводим базу в режим auto_vacuum=INCREMENTAL")
+                await conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                await conn.execute("VACUUM")
+        # Освобождаем страницы порциями, отпуская блокировку между ними
+        while True:
+            async with db.exclusive() as conn:
+                free = (await conn.execute_fetchall("PRAGMA freelist_count"))[0][0]
+                if not free:
+                    break
+                await conn.execute_fetchall(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES})")
+            await asyncio.sleep(RETENTION_PAUSE)
+        async with db.exclusive() as conn:
+            await conn.execute_fetchall("PRAGMA optimize")
+            await conn.execute_fetchall("PRAGMA wal_checkpoint(TRUNCATE)")
+
+retention = RetentionWorker()
+
+# ===== ПРОВЕРКА ЗДОРОВЬЯ =====
+# Статус бота, вебхука и базы обновляется в фоне; /health/* только читают кэш
+HEALTH_INTERVAL = float(os.getenv('HEALTH_INTERVAL', '30'))
+HEALTH_TIMEOUT = float(os.getenv('HEALTH_TIMEOUT', '10'))
+HEALTH_QUEUE_LIMIT = float(os.getenv('HEALTH_QUEUE_LIMIT', '0.9'))  # доля заполнения очереди
+# По умолчанию недоступность Telegram видна в ответе, но не снимает воркер с балансировки
+HEALTH_REQUIRE_TELEGRAM = os.getenv('HEALTH_REQUIRE_TELEGRAM', '0') == '1'
+
+class HealthMonitor:
+    def __init__(self):
+        self.telegram: Dict[str, Any] = {}
+        self.database: Dict[str, Any] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.gather(self._check_database(), self._check_telegram())
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def _check_database(self):
+        started = time.perf_counter()
+        try:
+            async def ping():
+                async with db.read('health') as conn:
+                    await conn.execute_fetchall("SELECT 1")
+            await asyncio.wait_for(ping(), HEALTH_TIMEOUT)
+            self.database = {"status": "ok", "latency_ms": round((time.perf_counter() - started) * 1000, 2)}
+        except Exception as e:
+            self.database = {"status": "error", "error": str(e) or type(e).__name__}
+        self.database["checked_at"] = time.time()
+
+    async def _check_telegram(self):
+        try:
+            bot_info, webhook_info = await asyncio.wait_for(
+                asyncio.gather(bot.get_me(), bot.get_webhook_info()), HEALTH_TIMEOUT
+            )
+            self.telegram = {
+                "status": "ok",
+                "id": bot_info.id,
+                "username": bot_info.username,
+                "webhook_url": webhook_info.url,
+                "pending_updates": webhook_info.pending_update_count,
+                "last_error": webhook_info.last_error_message,
+            }
+        except Exception as e:
+            logger.warning(f"Проверка Telegram не удалась: {e}")
+            self.telegram = {"status": "error", "error": str(e) or type(e).__name__}
+        self.telegram["checked_at"] = time.time()
+
+    def _fresh(self, check: Dict[str, Any]) -> bool:
+        return check.get("status") == "ok" and time.time() - check["checked_at"] < 3 * HEALTH_INTERVAL
 
-    data = await state.get_data()
-    docs = data.get('docs', [])
-    docs.append({
-        'file_id': message.document.file_id,
-        'file_name': message.document.file_name,
-        'file_type': message.document.mime_type,
-        'file_size': message.document.file_size
-    })
-    await state.update_data(docs=docs)
-    await message.answer("Документ добавлен!")
+    def readiness(self) -> Tuple[bool, Dict[str, Any]]:
+        checks = {
+            "database": {**self.database, "ok": db.is_open and self._fresh(self.database),
+                         "idle_readers": db.idle_readers()},
+            "telegram": {**self.telegram, "ok": self._fresh(self.telegram),
+                         "required": HEALTH_REQUIRE_TELEGRAM},
+        }
+        if WEBHOOK_MODE == 'queue':
+            depth = update_queue.depth()
+            checks["update_queue"] = {
+                "ok": update_queue.running and depth < update_queue.maxsize * HEALTH_QUEUE_LIMIT,
+                "depth": depth,
+                "capacity": update_queue.maxsize,
+            }
+        ready = all(check["ok"] for name, check in checks.items()
+                    if name != "telegram" or HEALTH_REQUIRE_TELEGRAM)
+        return ready, checks
 
-@dp.message(Command("done"), RequestForm.attach_docs)
-async def finish_handler(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    lang = await get_lang(state)
-    
-    if not all(k in data for k in ['name', 'phone', 'message_text']):
-        await message.answer(translations[lang]['error_missing_data'])
-        return
-        
-    async with aiosqlite.connect('bot.db') as db:
-        cursor = await db.execute(
-            """INSERT INTO requests 
-            (user_id, name, phone, message, created_at) 
-            VALUES (?, ?, ?, ?, ?)""",
-            (message.from_user.id, data['name'], data['phone'], data['message_text'], 
-             datetime.now(timezone.utc).isoformat())
-        )
-        request_id = cursor.lastrowid
-        
-        for doc in data.get('docs', []):
-            await db.execute(
-                """INSERT INTO documents 
-                (request_id, file_id, file_name, file_type, file_size, sent_at) 
-                VALUES (?, ?, ?, ?, ?, ?)""",
-                (request_id, doc['file_id'], doc['file_name'], doc['file_type'],
-                 doc['file_size'], datetime.now(timezone.utc).isoformat())
-            )
-        await db.commit()
-    
-    await message.answer(translations[lang]['thanks'], reply_markup=get_menu(lang))
-    await state.clear()
+health_monitor = HealthMonitor()
 
 # ===== FASTAPI НАСТРОЙКА =====
+async def start_background():
+    try:
+        await file_cache.load()
+    except OSError as e:
+        logger.error(f"Кэш файлов не загружен: {e}")
+    outbox.start()
+    health_monitor.start()
+    archiver.start()
+    admin_notifier.start()
+    retention.start()
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     try:
-        await init_db()
+        await db.open()
+        async with startup_lock():
+            await init_db()
+            # Файл FSM создается и переводится в WAL до приема обновлений
+            if isinstance(dp.storage, SQLiteStorage):
+                await dp.storage.open()
+        webhook_update_types.update(dp.resolve_used_update_types())
+        if WEBHOOK_MODE == 'queue':
+            update_queue.start()
+        if WRITE_BEHIND:
+            request_writer.start()
+        # Некритичное запускается, когда приложение уже принимает обновления
+        background = asyncio.create_task(start_background())
         logger.info("Приложение запущено")
         yield
         logger.info("Приложение завершает работу")
+        background.cancel()
+        await asyncio.gather(background, return_exceptions=True)
+        if WEBHOOK_MODE == 'queue':
+            await update_queue.stop()
+        await draft_attachments.stop()
+        await outbox.stop()
+        await request_writer.stop()
+        await health_monitor.stop()
+        await archiver.stop()
+        await admin_notifier.stop()
+        await retention.stop()
     except Exception as e:
         logger.error(f"Lifespan error: {e}")
         raise
+    finally:
+        await close_http_session()
+        await bot.session.close()
+        await throttling.close()
+        await dp.storage.close()
+        await db.close()
 
 app = FastAPI(lifespan=lifespan)
-templates = Jinja2Templates(directory="templates")
+# Jinja2 нужен только страницам админки: загружается при первом открытии
+_templates = None
+
+def get_templates():
+    global _templates
+    if _templates is None:
+        from fastapi.templating import Jinja2Templates
+        _templates = Jinja2Templates(directory="templates")
+    return _templates
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount(
     "/admin-react",
@@ -394,17 +2398,39 @@ app.add_middleware(
 )
 
 # ===== MIDDLEWARE =====
-app.add_middleware(SessionMiddleware, secret_key=os.getenv('SESSION_SECRET', 'secret'))
+# Секрет обязан совпадать во всех воркерах, иначе сессия админа будет теряться
+if not SESSION_SECRET:
+    logger.warning("SESSION_SECRET не установлен, используется небезопасное значение по умолчанию")
+app.add_middleware(SessionMiddleware, secret_key=SESSION_SECRET or 'secret')
+
+# Метка route — шаблон пути, а не сам путь, чтобы /download/{file_id} не плодил ряды
+@app.middleware("http")
+async def http_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        HTTP_SECONDS.labels(
+            request.method, route.path if route is not None else 'unmatched', str(status)
+        ).observe(time.perf_counter() - started)
 
 # ===== ROUTES =====
 
+@app.get("/metrics")
+async def metrics():
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/")
 async def root():
     return RedirectResponse("/admin-react/", status_code=302)
 
 @app.get("/admin/login")
 async def admin_login(request: Request):
-    return templates.TemplateResponse("admin_login.html", {"request": request})
+    return get_templates().TemplateResponse("admin_login.html", {"request": request})
 
 @app.get("/admin/logout")
 async def admin_logout(request: Request):
@@ -428,48 +2454,130 @@ async def admin_auth(
         request.session["auth"] = True
         return RedirectResponse("/admin-react", status_code=302)
 
-    return templates.TemplateResponse(
+    return get_templates().TemplateResponse(
         "admin_login.html",
         {"request": request, "error": "Неверные данные"},
         status_code=401
     )
 
-# Обрезаем длинные сообщения
+# ===== ПОСТРАНИЧНЫЙ СПИСОК ЗАЯВОК =====
+REQUESTS_PAGE_DEFAULT = 50
+REQUESTS_PAGE_MAX = 200
+
+def encode_cursor(created_at: str, request_id: int) -> str:
+    raw = f"{created_at}|{request_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, request_id = raw.rsplit("|", 1)
+        return created_at, int(request_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail="Некорректный cursor") from e
+
+def parse_date(value: Optional[str], name: str) -> Optional[date]:
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Некорректная дата {name}") from e
+
+def build_requests_filter(
+    status: Optional[str],
+    user_id: Optional[int],
+    date_from: Optional[str],
+    date_to: Optional[str],
+) -> Tuple[List[str], List]:
+    # created_at хранится в ISO-формате, поэтому границы дат сравниваются как строки
+    where, params = [], []
+    if status:
+        where.append("status = ?")
+        params.append(status)
+    if user_id is not None:
+        where.append("user_id = ?")
+        params.append(user_id)
+    start = parse_date(date_from, "date_from")
+    if start:
+        where.append("created_at >= ?")
+        params.append(start.isoformat())
+    end = parse_date(date_to, "date_to")
+    if end:
+        where.append("created_at < ?")
+        params.append((end + timedelta(days=1)).isoformat())
+    return where, params
+
+def shorten_message(message: Optional[str]) -> str:
+    # Обрезаем длинные сообщения
+    message = message or ""
+    if len(message) > 300:
+        message = message[:297] + "..."
+    return message
+
+async def fetch_documents(conn: aiosqlite.Connection, request_ids: List[int]) -> Dict[int, List[dict]]:
+    # Документы всей страницы одним запросом вместо запроса на каждую заявку
+    documents = {request_id: [] for request_id in request_ids}
+    if not request_ids:
+        return documents
+    placeholders = ",".join("?" * len(request_ids))
+    cursor = await conn.execute(
+        f"SELECT * FROM documents WHERE request_id IN ({placeholders}) ORDER BY id",
+        request_ids
+    )
+    for d in await cursor.fetchall():
+        documents[d["request_id"]].append(dict(d))
+    return documents
+
 @app.get("/admin/api/requests")
-async def api_requests(request: Request):
+async def api_requests(
+    request: Request,
+    limit: int = REQUESTS_PAGE_DEFAULT,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    user_id: Optional[int] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+):
     if not request.session.get("auth"):
         raise HTTPException(status_code=401)
 
+    limit = max(1, min(limit, REQUESTS_PAGE_MAX))
+    where, params = build_requests_filter(status, user_id, date_from, date_to)
+    if cursor:
+        # Keyset-пагинация по (created_at, id): стоимость страницы не зависит от её номера
+        where.append("(created_at, id) < (?, ?)")
+        params.extend(decode_cursor(cursor))
+
+    sql = "SELECT id, user_id, name, phone, message, created_at, status FROM requests"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+    params.append(limit + 1)
+
     try:
-        async with aiosqlite.connect("bot.db") as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute("SELECT * FROM requests ORDER BY created_at DESC")
-            rows = await cursor.fetchall()
+        async with db.read('requests_page') as conn:
+            rows = await (await conn.execute(sql, params)).fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            documents = await fetch_documents(conn, [r["id"] for r in rows])
 
-        result = []
-        for r in rows:
-            async with aiosqlite.connect("bot.db") as db:
-                db.row_factory = aiosqlite.Row
-                docs_cursor = await db.execute("SELECT * FROM documents WHERE request_id = ?", (r["id"],))
-                docs = await docs_cursor.fetchall()
-            
-            # Исправлено: обращение к полю через индекс вместо .get()
-            message = r["message"] if "message" in r.keys() else ""
-            if len(message) > 300:
-                message = message[:297] + "..."
-            
-            result.append({
-                "id": r["id"],
-                "user_id": r["user_id"],
-                "name": r["name"],
-                "phone": r["phone"],
-                "message": message,
-                "created_at": r["created_at"],
-                "status": r["status"],
-                "documents": [dict(d) for d in docs]
-            })
-
-        return result
+        items = [{
+            "id": r["id"],
+            "user_id": r["user_id"],
+            "name": r["name"],
+            "phone": r["phone"],
+            "message": shorten_message(r["message"]),
+            "created_at": r["created_at"],
+            "status": r["status"],
+            "documents": documents[r["id"]]
+        } for r in rows]
+
+        next_cursor = None
+        if has_more and rows:
+            next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+
+        return {"items": items, "next_cursor": next_cursor}
 
     except Exception as e:
         logger.error(f"Ошибка при получении заявок: {str(e)}")
@@ -478,6 +2586,470 @@ async def api_requests(request: Request):
             content={"error": "Internal server error"}
         )
 
+# ===== СТАТИСТИКА ЗАЯВОК =====
+# Счетчики ведут триггеры миграции 10; здесь только чтение и полный пересчет
+STATS_DAYS_DEFAULT = 30
+STATS_DAYS_MAX = 366
+
+async def rebuild_stats_tables(conn: aiosqlite.Connection, archived: Optional[Dict[str, int]] = None):
+    # Пересчет с нуля: статусы по рабочей базе, поступление по рабочей базе и архивам,
+    # завершения по истории статусов
+    await conn.execute("DELETE FROM stats_status")
+    await conn.execute("""
+        INSERT INTO stats_status (status, requests)
+        SELECT COALESCE(status, 'new'), COUNT(*) FROM requests GROUP BY 1
+    """)
+    await conn.execute("DELETE FROM stats_daily")
+    await conn.execute("""
+        INSERT INTO stats_daily (day, created)
+        SELECT substr(created_at, 1, 10), COUNT(*) FROM requests GROUP BY 1
+    """)
+    if archived:
+        await conn.executemany(
+            """INSERT INTO stats_daily (day, created) VALUES (?, ?)
+            ON CONFLICT(day) DO UPDATE SET created = created + excluded.created""",
+            list(archived.items())
+        )
+    await conn.execute("""
+        INSERT INTO stats_daily (day, resolved, resolution_seconds)
+        SELECT substr(h.changed_at, 1, 10), COUNT(*),
+               SUM((julianday(h.changed_at) - julianday(COALESCE(c.changed_at, r.created_at))) * 86400)
+        FROM request_status_history h
+        LEFT JOIN request_status_history c ON c.request_id = h.request_id AND c.old_status IS NULL
+        LEFT JOIN requests r ON r.id = h.request_id
+        WHERE h.new_status = 'done' AND h.old_status IS NOT NULL
+          AND COALESCE(c.changed_at, r.created_at) IS NOT NULL
+        GROUP BY 1
+        ON CONFLICT(day) DO UPDATE SET
+            resolved = excluded.resolved,
+            resolution_seconds = excluded.resolution_seconds
+    """)
+
+async def rebuild_stats() -> Dict[str, int]:
+    # Пока идет пересчет, архивация не переносит заявки: иначе часть посчиталась бы дважды
+    with open(RETENTION_LOCK_PATH, 'w') as lock_file:
+        await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+        archived: Dict[str, int] = {}
+        partitions = archive_partitions()
+        for month in partitions:
+            async with aiosqlite.connect(archive_path(month)) as arc:
+                for day, count in await arc.execute_fetchall(
+                    "SELECT substr(created_at, 1, 10), COUNT(*) FROM requests GROUP BY 1"
+                ):
+                    archived[day] = archived.get(day, 0) + count
+        async with db.write('stats_rebuild') as conn:
+            await rebuild_stats_tables(conn, archived)
+            days, requests, resolved = (await conn.execute_fetchall(
+                "SELECT COUNT(*), COALESCE(SUM(created), 0), COALESCE(SUM(resolved), 0) FROM stats_daily"
+            ))[0]
+    result = {"days": days, "requests": requests, "resolved": resolved, "archive_partitions": len(partitions)}
+    logger.info(f"Статистика заявок пересчитана: {result}")
+    return result
+
+def average_hours(seconds: float, count: int) -> Optional[float]:
+    return round(seconds / count / 3600, 2) if count else None
+
+@app.get("/admin/api/stats")
+async def api_stats(request: Request, days: int = STATS_DAYS_DEFAULT):
+    if not request.session.get("auth"):
+        raise HTTPException(status_code=401)
+
+    days = max(0, min(days, STATS_DAYS_MAX))
+    today = datetime.now(timezone.utc).date()
+    since = (today - timedelta(days=max(days - 1, 0))).isoformat()
+    async with db.read('stats') as conn:
+        statuses = await conn.execute_fetchall(
+            "SELECT status, requests FROM stats_status WHERE requests != 0 ORDER BY status"
+        )
+        daily = await conn.execute_fetchall(
+            """SELECT day, created, resolved, resolution_seconds FROM stats_daily
+               WHERE day >= ? ORDER BY day""",
+            (since,)
+        ) if days else []
+
+    # Дни без заявок тоже попадают в ответ, чтобы график не склеивал пропуски
+    by_day = {row['day']: row for row in daily}
+    buckets = []
+    for offset in range(days - 1, -1, -1):
+        day = (today - timedelta(days=offset)).isoformat()
+        row = by_day.get(day)
+        created, resolved, seconds = (row['created'], row['resolved'], row['resolution_seconds']) if row else (0, 0, 0.0)
+        buckets.append({
+            "day": day,
+            "created": created,
+            "resolved": resolved,
+            "avg_resolution_hours": average_hours(seconds, resolved),
+        })
+
+    period_resolved = sum(row['resolved'] for row in daily)
+    return {
+        "statuses": {row['status']: row['requests'] for row in statuses},
+        "total": sum(row['requests'] for row in statuses),
+        "period": {
+            "days": days,
+            "created": sum(row['created'] for row in daily),
+            "resolved": period_resolved,
+            "avg_resolution_hours": average_hours(sum(row['resolution_seconds'] for row in daily), period_resolved),
+        },
+        "daily": buckets,
+    }
+
+@app.post("/admin/api/stats/rebuild")
+async def api_stats_rebuild(request: Request):
+    if not request.session.get("auth"):
+        raise HTTPException(status_code=401)
+    return {"ok": True, **await rebuild_stats()}
+
+# ===== ВЫГРУЗКА ЗАЯВОК =====
+# Выгрузка читает базу пачками через отдельное соединение и сразу отдает их клиенту,
+# поэтому память не растет с числом строк; при обрыве соединения генератор отменяется
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+EXPORT_COLUMNS = ("id", "user_id", "name", "phone", "message", "status", "created_at", "documents")
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+# Управляющие символы недопустимы в XML листа
+XML_ILLEGAL_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+async def iter_export_rows(where: List[str], params: List):
+    sql = "SELECT id, user_id, name, phone, message, status, created_at FROM requests"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY created_at, id"
+
+    # Отдельное соединение, чтобы долгая выгрузка не занимала читателя из пула
+    conn = await aiosqlite.connect(DB_PATH)
+    conn.row_factory = aiosqlite.Row
+    try:
+        cursor = await conn.execute(sql, params)
+        while True:
+            rows = await cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            documents = await fetch_documents(conn, [r["id"] for r in rows])
+            yield [{**dict(r), "documents": documents[r["id"]]} for r in rows]
+    finally:
+        # При отмене выгрузки закрытие все равно должно дойти до конца
+        await asyncio.shield(conn.close())
+
+def document_names(documents: List[dict]) -> str:
+    return "; ".join(d["file_name"] or d["file_id"] for d in documents)
+
+async def export_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM нужен Excel, чтобы открыть кириллицу без мастера импорта
+    buffer.write("\ufeff")
+    writer.writerow(EXPORT_COLUMNS)
+    async for rows in batches:
+        for r in rows:
+            writer.writerow([*(r[c] for c in EXPORT_COLUMNS[:-1]), document_names(r["documents"])])
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+async def export_jsonl(batches):
+    async for rows in batches:
+        yield "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows).encode("utf-8")
+
+class StreamBuffer(io.RawIOBase):
+    # Неперематываемый приемник для zipfile: записанное забирается кусками через drain()
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def xlsx_cell(value) -> str:
+    if value is None:
+        return "<c/>"
+    if isinstance(value, int):
+        return f"<c><v>{value}</v></c>"
+    text = xml_escape(XML_ILLEGAL_CHARS.sub("", str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+def xlsx_row(values) -> str:
+    return "<row>" + "".join(xlsx_cell(v) for v in values) + "</row>"
+
+XLSX_STATIC_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="requests" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+async def export_xlsx(batches):
+    # Минимальная книга из одного листа со строками inlineStr, без общей таблицы строк
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_STATIC_PARTS.items():
+            archive.writestr(name, content)
+        with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                + xlsx_row(EXPORT_COLUMNS)
+            ).encode("utf-8"))
+            async for rows in batches:
+                sheet.write("".join(
+                    xlsx_row([*(r[c] for c in EXPORT_COLUMNS[:-1]), document_names(r["documents"])])
+                    for r in rows
+                ).encode("utf-8"))
+                yield buffer.drain()
+            sheet.write(b"</sheetData></worksheet>")
+    yield buffer.drain()
+
+EXPORT_WRITERS = {"csv": export_csv, "jsonl": export_jsonl, "xlsx": export_xlsx}
+
+class ExportResponse(StreamingResponse):
+    # При обрыве соединения Starlette бросает генераторы на сборщик мусора;
+    # закрываем их сами, чтобы соединение с базой освобождалось сразу
+    def __init__(self, format: str, rows, **kwargs):
+        self.rows = rows
+        super().__init__(EXPORT_WRITERS[format](rows), media_type=EXPORT_MEDIA_TYPES[format], **kwargs)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+            await self.rows.aclose()
+
+@app.get("/admin/api/export")
+async def api_export(
+    request: Request,
+    format: str = "csv",
+    status: Optional[str] = None,
+    user_id: Optional[int] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+):
+    if not request.session.get("auth"):
+        raise HTTPException(status_code=401)
+    if format not in EXPORT_WRITERS:
+        raise HTTPException(status_code=400, detail=f"Формат выгрузки: {', '.join(EXPORT_WRITERS)}")
+
+    where, params = build_requests_filter(status, user_id, date_from, date_to)
+    filename = f"requests-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}.{format}"
+    return ExportResponse(
+        format,
+        iter_export_rows(where, params),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+# ===== АРХИВ ЗАЯВОК =====
+@app.get("/admin/api/archive")
+async def api_archive(
+    request: Request,
+    limit: int = REQUESTS_PAGE_DEFAULT,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    user_id: Optional[int] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+):
+    if not request.session.get("auth"):
+        raise HTTPException(status_code=401)
+
+    limit = max(1, min(limit, REQUESTS_PAGE_MAX))
+    where, params = build_requests_filter(status, user_id, date_from, date_to)
+    # Открываются только месяцы, попадающие в фильтр дат и лежащие не позже курсора
+    start = parse_date(date_from, "date_from")
+    end = parse_date(date_to, "date_to")
+    months = [m for m in archive_partitions()
+              if (not start or m >= start.strftime("%Y-%m")) and (not end or m <= end.strftime("%Y-%m"))]
+    if cursor:
+        position = decode_cursor(cursor)
+        where.append("(created_at, id) < (?, ?)")
+        params.extend(position)
+        months = [m for m in months if m <= position[0][:7]]
+
+    sql = f"SELECT {ARCHIVE_REQUEST_COLUMNS}, archived_at FROM requests"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+
+    items = []
+    for month in months:
+        conn = await aiosqlite.connect(f"file:{quote(archive_path(month))}?mode=ro", uri=True)
+        conn.row_factory = aiosqlite.Row
+        try:
+            rows = await conn.execute_fetchall(sql, (*params, limit + 1 - len(items)))
+            documents = await fetch_documents(conn, [r["id"] for r in rows])
+        finally:
+            await conn.close()
+        items += [{**dict(r), "message": shorten_message(r["message"]), "documents": documents[r["id"]]}
+                  for r in rows]
+        if len(items) > limit:
+            break
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1]["created_at"], items[-1]["id"])
+    return {"items": items, "next_cursor": next_cursor, "partitions": months}
+
+# ===== ПОЛНОТЕКСТОВЫЙ ПОИСК =====
+SEARCH_PAGE_DEFAULT = 20
+HIGHLIGHT_START = '\ue000'
+HIGHLIGHT_END = '\ue001'
+SEARCH_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+def build_match_query(query: str) -> str:
+    # Каждое слово ищется как префикс, все слова обязательны
+    tokens = SEARCH_TOKEN_RE.findall(query)
+    return " ".join(f'"{token}"*' for token in tokens)
+
+def render_highlight(text: Optional[str]) -> str:
+    # Экранируем HTML и только потом превращаем маркеры FTS5 в <mark>
+    return html.escape(text or "").replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_END, "</mark>")
+
+@app.get("/admin/api/search")
+async def api_search(
+    request: Request,
+    q: str,
+    limit: int = SEARCH_PAGE_DEFAULT,
+    offset: int = 0,
+    status: Optional[str] = None,
+):
+    if not request.session.get("auth"):
+        raise HTTPException(status_code=401)
+
+    match = build_match_query(q)
+    if not match:
+        raise HTTPException(status_code=400, detail="Пустой поисковый запрос")
+    limit = max(1, min(limit, REQUESTS_PAGE_MAX))
+    offset = max(0, offset)
+
+    sql = f"""SELECT r.id, r.user_id, r.name, r.phone, r.message, r.created_at, r.status,
+            highlight(requests_fts, 0, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}') AS name_hl,
+            highlight(requests_fts, 1, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}') AS phone_hl,
+            snippet(requests_fts, 2, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '…', 32) AS message_hl,
+            requests_fts.rank AS rank
+        FROM requests_fts
+        JOIN requests r ON r.id = requests_fts.rowid
+        WHERE requests_fts MATCH ?"""
+    params: List = [match]
+    if status:
+        sql += " AND r.status = ?"
+        params.append(status)
+    sql += " ORDER BY requests_fts.rank LIMIT ? OFFSET ?"
+    params.extend([limit + 1, offset])
+
+    try:
+        async with db.read('search') as conn:
+            rows = await (await conn.execute(sql, params)).fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            documents = await fetch_documents(conn, [r["id"] for r in rows])
+    except Exception as e:
+        logger.error(f"Ошибка полнотекстового поиска: {str(e)}")
+        return JSONResponse(status_code=500, content={"error": "Internal server error"})
+
+    items = [{
+        "id": r["id"],
+        "user_id": r["user_id"],
+        "name": r["name"],
+        "phone": r["phone"],
+        "message": shorten_message(r["message"]),
+        "created_at": r["created_at"],
+        "status": r["status"],
+        "documents": documents[r["id"]],
+        "rank": r["rank"],
+        "highlight": {
+            "name": render_highlight(r["name_hl"]),
+            "phone": render_highlight(r["phone_hl"]),
+            "message": render_highlight(r["message_hl"]),
+        }
+    } for r in rows]
+
+    return {"items": items, "next_offset": offset + limit if has_more else None}
+
+# ===== ЛЕНТА СОБЫТИЙ (SSE) =====
+async def read_events(after_id: int) -> list:
+    async with db.read('events') as conn:
+        cursor = await conn.execute(
+            "SELECT id, type, payload FROM admin_events WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, SSE_BATCH_SIZE)
+        )
+        return await cursor.fetchall()
+
+@app.get("/admin/api/events")
+async def api_events(request: Request, last_id: Optional[int] = None):
+    if not request.session.get("auth"):
+        raise HTTPException(status_code=401)
+
+    # EventSource сам присылает Last-Event-ID при переподключении
+    header_id = request.headers.get("last-event-id")
+    if header_id and header_id.isdigit():
+        last_id = int(header_id)
+    if last_id is None:
+        async with db.read('events_last_id') as conn:
+            cursor = await conn.execute("SELECT COALESCE(MAX(id), 0) FROM admin_events")
+            last_id = (await cursor.fetchone())[0]
+
+    async def stream(last_id: int):
+        yield f"retry: 5000\nid: {last_id}\n\n"
+        while True:
+            changed = admin_events.snapshot()
+            events = await read_events(last_id)
+            for event in events:
+                last_id = event["id"]
+                yield f"id: {event['id']}\nevent: {event['type']}\ndata: {event['payload']}\n\n"
+            if len(events) == SSE_BATCH_SIZE:
+                continue
+            if not await admin_events.wait(changed, SSE_HEARTBEAT):
+                yield ": ping\n\n"
+
+    return StreamingResponse(
+        stream(last_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/admin/update")
 async def update_request(
     request: Request,
@@ -489,39 +3061,38 @@ async def update_request(
         raise HTTPException(status_code=401)
     
     try:
-        # Получаем данные о заявке
-        async with aiosqlite.connect("bot.db") as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute("SELECT * FROM requests WHERE id = ?", (request_id,))
+        # Получаем данные о заявке, обновляем статус и ставим ответ в очередь
+        # в одной транзакции; отправкой занимается планировщик outbox
+        message_id = None
+        async with db.write('update_status') as conn:
+            cursor = await conn.execute("SELECT * FROM requests WHERE id = ?", (request_id,))
             request_data = await cursor.fetchone()
             
             if not request_data:
                 return JSONResponse({"ok": False, "error": "Заявка не найдена"}, status_code=404)
             
             # Обновляем статус в базе данных
-            await db.execute(
+            await conn.execute(
                 "UPDATE requests SET status = ? WHERE id = ?",
                 (status, request_id)
             )
-            await db.commit()
+            if status != request_data["status"]:
+                await publish_event(conn, "status_changed", request_id, {"id": request_id, "status": status})
             
             # Если есть ответ для пользователя
             if reply:
-                user_id = request_data["user_id"]
-                
-                # Отправляем сообщение пользователю через бота
-                try:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=f"✉️ Ответ от администратора:\n\n{reply}"
-                    )
-                    logger.info(f"Сообщение отправлено пользователю {user_id}: {reply}")
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
-                    return JSONResponse(
-                        {"ok": False, "error": f"Ошибка отправки сообщения: {str(e)}"},
-                        status_code=500
-                    )
+                message_id = await enqueue_message(
+                    conn,
+                    request_data["user_id"],
+                    f"✉️ Ответ от администратора:\n\n{html.escape(reply)}",
+                    request_id
+                )
+        
+        admin_events.notify()
+        if message_id is not None:
+            outbox.wake()
+            logger.info(f"Ответ пользователю {request_data['user_id']} поставлен в очередь: #{message_id}")
+            return JSONResponse({"ok": True, "message_id": message_id})
         
         return JSONResponse({"ok": True})
     
@@ -532,22 +3103,148 @@ async def update_request(
             status_code=500
         )
         
+@app.post("/admin/notify")
+async def notify_requests(
+    request: Request,
+    status: str = Form(...),
+    text: str = Form(...)
+):
+    if not request.session.get("auth"):
+        raise HTTPException(status_code=401)
+
+    # Сообщения уходят с parse_mode HTML: текст администратора экранируется.
+    # Одно сообщение на пользователя, даже если у него несколько заявок в статусе
+    async with db.write('notify') as conn:
+        cursor = await conn.execute(
+            """INSERT INTO outbox (chat_id, text, request_id, next_attempt_at, created_at)
+            SELECT user_id, ?, MAX(id), ?, ? FROM requests
+            WHERE status = ? AND user_id IS NOT NULL
+            GROUP BY user_id""",
+            (html.escape(text), time.time(), utc_now(), status)
+        )
+        queued = cursor.rowcount
+    outbox.wake()
+    logger.info(f"Рассылка по статусу {status!r}: в очереди {queued} сообщений")
+    return JSONResponse({"ok": True, "queued": queued})
+
+@app.get("/admin/api/outbox")
+async def api_outbox(
+    request: Request,
+    limit: int = REQUESTS_PAGE_DEFAULT,
+    cursor: Optional[int] = None,
+    status: Optional[str] = None,
+    request_id: Optional[int] = None,
+):
+    if not request.session.get("auth"):
+        raise HTTPException(status_code=401)
+
+    limit = max(1, min(limit, REQUESTS_PAGE_MAX))
+    where, params = [], []
+    if status:
+        where.append("status = ?")
+        params.append(status)
+    if request_id is not None:
+        where.append("request_id = ?")
+        params.append(request_id)
+    if cursor is not None:
+        where.append("id < ?")
+        params.append(cursor)
+
+    sql = """SELECT id, chat_id, request_id, text, status, attempts, error, created_at, sent_at
+        FROM outbox"""
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit + 1)
+
+    async with db.read('outbox_stats') as conn:
+        rows = await (await conn.execute(sql, params)).fetchall()
+
+    items = [dict(r) for r in rows[:limit]]
+    next_cursor = items[-1]["id"] if len(rows) > limit else None
+    return {
+        "items": items,
+        "next_cursor": next_cursor,
+        "scheduler": {"sent": outbox.sent, "failed": outbox.failed, "retried": outbox.retried}
+    }
+
+# ===== ПРИЕМ ОБНОВЛЕНИЙ =====
+# WEBHOOK_SECRET совпадает с secret_token из setWebhook: Telegram присылает его в заголовке,
+# и чужой запрос отклоняется до чтения тела. Тело разбирается orjson один раз, а обновления
+# типов, на которые нет обработчиков, отбрасываются без валидации в модели aiogram
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+WEBHOOK_OK = b'{"ok":true}'
+
+WEBHOOK_UPDATES = Counter(
+    'legalbot_webhook_updates_total', 'Входящие обновления webhook по типу и исходу', ['type', 'result']
+)
+
+# Типы обновлений, на которые есть обработчики; заполняется при старте приложения
+webhook_update_types: set = set()
+
+class RejectedUpdate(ValueError):
+    def __init__(self, update_type: str, error: str):
+        super().__init__(error)
+        self.update_type = update_type
+
+def parse_update(body: bytes) -> Tuple[str, Optional[types.Update]]:
+    # Возвращает тип обновления и модель; None — тип никем не обрабатывается
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        raise RejectedUpdate('unknown', f"Invalid JSON: {e}")
+    if not isinstance(data, dict) or 'update_id' not in data:
+        raise RejectedUpdate('unknown', "Update object expected")
+    if LOG_UPDATES_SAMPLE and random.random() < LOG_UPDATES_SAMPLE:
+        logger.info(f"Received update data: {data}")
+    # В обновлении кроме update_id ровно одно поле — его тип
+    update_type = next((key for key in data if key != 'update_id'), 'unknown')
+    if update_type not in webhook_update_types:
+        return update_type, None
+    try:
+        # С контекстом бота feed_update берет модель как есть, без model_dump и второй валидации
+        return update_type, types.Update.model_validate(data, context={"bot": bot})
+    except ValidationError as e:
+        raise RejectedUpdate(update_type, f"Invalid update: {e.error_count()} errors")
+
+def webhook_secret_valid(request: Request) -> bool:
+    if not WEBHOOK_SECRET:
+        return True
+    token = request.headers.get(WEBHOOK_SECRET_HEADER, '')
+    return hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode())
+
 @app.post("/webhook")
 async def webhook_handler(request: Request):
+    if not webhook_secret_valid(request):
+        WEBHOOK_UPDATES.labels('unknown', 'forbidden').inc()
+        return JSONResponse(status_code=403, content={"ok": False, "error": "Invalid secret token"})
+
     try:
-        update_data = await request.json()
-        logger.info(f"Received update data: {update_data}")
-        
-        try:
-            update = types.Update.model_validate(update_data)
-        except Exception as e:
-            logger.error(f"Error creating Update object: {e}")
-            update = types.Update(**update_data)
-        
-        logger.info(f"Created update object: {type(update)}")
-        
-        await dp.feed_update(bot, update)
-        return {"ok": True}
+        update_type, update = parse_update(await request.body())
+    except RejectedUpdate as e:
+        # Повтор того же тела не поможет, а на любой не-2xx Telegram пришлет его снова:
+        # учитываем отказ и подтверждаем доставку
+        WEBHOOK_UPDATES.labels(e.update_type, 'rejected').inc()
+        logger.warning(f"Отклонено обновление типа {e.update_type}: {e}")
+        return Response(WEBHOOK_OK, media_type="application/json")
+    if update is None:
+        WEBHOOK_UPDATES.labels(update_type, 'ignored').inc()
+        return Response(WEBHOOK_OK, media_type="application/json")
+
+    try:
+        if WEBHOOK_MODE == 'queue':
+            # Ставим обновление в очередь и сразу отвечаем Telegram
+            if not await update_queue.put(update):
+                WEBHOOK_UPDATES.labels(update_type, 'dropped').inc()
+                return JSONResponse(
+                    status_code=503,
+                    content={"ok": False, "error": "Update queue is full"}
+                )
+        else:
+            await dp.feed_update(bot, update)
+        WEBHOOK_UPDATES.labels(update_type, 'accepted').inc()
+        return Response(WEBHOOK_OK, media_type="application/json")
     except Exception as e:
         logger.error(f"Webhook error: {str(e)}")
         return JSONResponse(
@@ -572,58 +3269,505 @@ async def webhook_get():
         }
     )
 
+@app.get("/webhook/stats")
+async def webhook_stats():
+    return {**update_queue.stats(), "throttling": throttling.stats()}
+
 @app.get("/health")
 async def health_check():
-    try:
-        bot_info = await bot.get_me()
-        webhook_info = await bot.get_webhook_info()
-        return {
-            "status": "ok",
-            "bot": {
-                "id": bot_info.id,
-                "username": bot_info.username,
-                "webhook_url": webhook_info.url,
-                "pending_updates": webhook_info.pending_update_count
-            },
-            "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-        }
-    except Exception as e:
+    # Прежний формат ответа, но из кэша монитора — без живых вызовов Telegram
+    telegram = health_monitor.telegram
+    if telegram.get("status") != "ok":
         return JSONResponse(
             status_code=500,
             content={
                 "status": "error",
-                "error": str(e),
+                "error": telegram.get("error", "Статус Telegram еще не получен"),
                 "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
             }
         )
+    return {
+        "status": "ok",
+        "bot": {key: telegram[key] for key in ("id", "username", "webhook_url", "pending_updates")},
+        "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    }
 
-@app.get("/download/{file_id}")
-async def download_file(file_id: str):
+@app.get("/health/live")
+async def health_live():
+    # Процесс жив и цикл событий отвечает; ничего внешнего не проверяется
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def health_ready():
+    ready, checks = health_monitor.readiness()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ok" if ready else "unavailable", "checks": checks}
+    )
+
+# ===== СКАЧИВАНИЕ ДОКУМЕНТОВ =====
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_CACHE_DIR = os.getenv('DOWNLOAD_CACHE_DIR', 'cache/files')
+DOWNLOAD_CACHE_MAX_BYTES = int(os.getenv('DOWNLOAD_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '32'))
+# Telegram гарантирует работу ссылки на файл не меньше часа
+FILE_PATH_TTL = 50 * 60
+FILE_PATH_CACHE_SIZE = 10000
+
+http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    # Одна общая сессия с пулом соединений вместо новой сессии на каждый запрос
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
+        )
+    return http_session
+
+async def close_http_session():
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+
+# Дисковый кэш содержимого файлов по file_unique_id с вытеснением LRU по размеру
+class FileCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    async def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Каталог сканируется в потоке, пока приложение уже принимает обновления
+        files = await asyncio.to_thread(self._scan, time.time())
+        # Файлы, скачанные за время сканирования, уже учтены и остаются самыми свежими
+        entries = OrderedDict((key, size) for _, key, size in sorted(files) if key not in self._entries)
+        self.size += sum(entries.values())
+        entries.update(self._entries)
+        self._entries = entries
+        self._evict()
+        logger.info(f"Кэш файлов: {len(self._entries)} файлов, {self.size} байт")
+
+    def _scan(self, started: float) -> List[Tuple[float, str, int]]:
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if entry.name.endswith('.part'):
+                # Недокачанные файлы прошлых запусков; текущие загрузки не трогаем
+                if stat.st_mtime < started:
+                    os.remove(entry.path)
+                continue
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        return files
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[str]:
+        if key not in self._entries:
+            return None
+        path = self.path(key)
+        if not os.path.exists(path):
+            self.size -= self._entries.pop(key)
+            return None
+        self._entries.move_to_end(key)
+        # mtime хранит порядок LRU между перезапусками
+        os.utime(path)
+        return path
+
+    def temp_path(self, key: str) -> str:
+        return f"{self.path(key)}.{os.getpid()}.{time.monotonic_ns()}.part"
+
+    def commit(self, key: str, temp_path: str):
+        size = os.path.getsize(temp_path)
+        if size > self.max_bytes:
+            os.remove(temp_path)
+            return
+        os.replace(temp_path, self.path(key))
+        self.size += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+file_cache = FileCache(DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_MAX_BYTES)
+
+# file_id -> (время истечения, types.File): путь к файлу живет ограниченное время
+file_info_cache: OrderedDict = OrderedDict()
+# file_id -> (file_unique_id, имя файла): не меняются, хранятся без срока
+known_files: OrderedDict = OrderedDict()
+
+def remember(cache: OrderedDict, key, value, limit: int = FILE_PATH_CACHE_SIZE):
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > limit:
+        cache.popitem(last=False)
+
+async def resolve_file(file_id: str) -> types.File:
+    cached = file_info_cache.get(file_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    file = await bot.get_file(file_id)
+    remember(file_info_cache, file_id, (time.monotonic() + FILE_PATH_TTL, file))
+    remember(known_files, file_id, (file.file_unique_id, file.file_path.split("/")[-1]))
+    return file
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    # Поддерживается один диапазон: bytes=start-end, bytes=start- и bytes=-suffix
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start_value, _, end_value = header[6:].strip().partition('-')
     try:
-        file = await bot.get_file(file_id)
-        file_path = file.file_path
-        api_token = os.getenv("BOT_TOKEN") or API_TOKEN
-        file_url = f"https://api.telegram.org/file/bot{api_token}/{file_path}"
+        if start_value:
+            start = int(start_value)
+            end = int(end_value) if end_value else size - 1
+        else:
+            start = max(0, size - int(end_value))
+            end = size - 1
+    except ValueError:
+        return None
+    end = min(end, size - 1)
+    if start > end:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+async def iter_file(path: str, offset: int, length: int):
+    async with aiofiles.open(path, 'rb') as f:
+        await f.seek(offset)
+        while length > 0:
+            chunk = await f.read(min(DOWNLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def serve_local_file(path: str, range_header: Optional[str], headers: Dict[str, str]) -> StreamingResponse:
+    size = os.path.getsize(path)
+    byte_range = parse_range(range_header, size)
+    start, end = byte_range or (0, size - 1)
+    headers = {**headers, "Content-Length": str(end - start + 1)}
+    status_code = 200
+    if byte_range:
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(
+        iter_file(path, start, end - start + 1),
+        status_code=status_code,
+        media_type="application/octet-stream",
+        headers=headers
+    )
+
+async def proxy_telegram_file(file: types.File, range_header: Optional[str], headers: Dict[str, str]) -> StreamingResponse:
+    file_url = bot.session.api.file_url(bot.token, file.file_path)
+    upstream_headers = {"Range": range_header} if range_header else {}
+    resp = await get_http_session().get(file_url, headers=upstream_headers)
+    if resp.status not in (200, 206):
+        resp.release()
+        raise HTTPException(status_code=resp.status, detail="Не удалось загрузить файл")
+
+    headers = dict(headers)
+    for name in ("Content-Length", "Content-Range"):
+        if name in resp.headers:
+            headers[name] = resp.headers[name]
+
+    # В кэш попадает только полный ответ, частичные передаются как есть
+    temp_path = file_cache.temp_path(file.file_unique_id) if resp.status == 200 else None
+
+    async def stream():
+        out = None
+        completed = False
+        try:
+            if temp_path:
+                out = await aiofiles.open(temp_path, 'wb')
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                if out:
+                    await out.write(chunk)
+                yield chunk
+            completed = True
+        finally:
+            resp.release()
+            if out:
+                await out.close()
+                if completed:
+                    file_cache.commit(file.file_unique_id, temp_path)
+                else:
+                    os.remove(temp_path)
+
+    return StreamingResponse(
+        stream(),
+        status_code=resp.status,
+        media_type="application/octet-stream",
+        headers=headers
+    )
+
+# ===== АРХИВ ДОКУМЕНТОВ =====
+# После сохранения заявки документы скачиваются из Telegram в локальное хранилище,
+# адресуемое содержимым (sha256): одинаковые файлы лежат в одном экземпляре.
+# Очередь — сами строки documents без storage_key, поэтому перезапуск ничего не теряет
+# Рядом с базой: на хостинге постоянный том смонтирован только под нее
+STORAGE_DIR = os.getenv('STORAGE_DIR', os.path.join(os.path.dirname(DB_PATH), 'storage'))
+ARCHIVE_WORKERS = int(os.getenv('ARCHIVE_WORKERS', '4'))
+ARCHIVE_BATCH_SIZE = 20
+ARCHIVE_MAX_ATTEMPTS = int(os.getenv('ARCHIVE_MAX_ATTEMPTS', '5'))
+ARCHIVE_RETRY_DELAY = float(os.getenv('ARCHIVE_RETRY_DELAY', '60'))
+ARCHIVE_POLL_INTERVAL = float(os.getenv('ARCHIVE_POLL_INTERVAL', '30'))
+# Сколько документ закреплен за воркером, прежде чем его сможет взять другой процесс
+ARCHIVE_LEASE = 600
+# Внутренний location nginx над STORAGE_DIR: с ним файл отдает nginx через sendfile
+STORAGE_ACCEL_PREFIX = os.getenv('STORAGE_ACCEL_PREFIX')
+
+ARCHIVED_DOCUMENTS = Counter(
+    'legalbot_archived_documents_total', 'Скачивание документов в архив', ['result']
+)
+
+# Локальное хранилище по ключу содержимого. Интерфейс (temp_path/put/path) нарочно узкий,
+# чтобы на его место можно было поставить S3-совместимое хранилище
+class ContentStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def relative_path(self, key: str) -> str:
+        return os.path.join(key[:2], key[2:4], key)
+
+    def temp_path(self) -> str:
+        # Каталог мог пропасть вместе с хранилищем после старта
+        temp_dir = os.path.join(self.directory, 'tmp')
+        os.makedirs(temp_dir, exist_ok=True)
+        return os.path.join(temp_dir, f"{os.getpid()}.{time.monotonic_ns()}.part")
+
+    def prepare(self):
+        # Недокачанные файлы остаются после падения процесса; свежие могут принадлежать соседнему воркеру
+        temp_dir = os.path.join(self.directory, 'tmp')
+        os.makedirs(temp_dir, exist_ok=True)
+        for entry in os.scandir(temp_dir):
+            if entry.is_file() and entry.stat().st_mtime < time.time() - ARCHIVE_LEASE:
+                os.remove(entry.path)
+
+    def put(self, temp_path: str, key: str):
+        path = os.path.join(self.directory, self.relative_path(key))
+        if os.path.exists(path):
+            os.remove(temp_path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    def path(self, key: str) -> Optional[str]:
+        path = os.path.join(self.directory, self.relative_path(key))
+        return path if os.path.exists(path) else None
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_url) as resp:
+content_store = ContentStore(STORAGE_DIR)
+
+class DocumentArchiver:
+    def __init__(self, store: ContentStore):
+        self.store = store
+        self._queue: Optional[asyncio.Queue] = None
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self.store.prepare()
+        self._queue = asyncio.Queue(maxsize=ARCHIVE_WORKERS * 2)
+        self._tasks = [asyncio.create_task(self._claim_loop())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(ARCHIVE_WORKERS)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _claim_loop(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                claimed = await self._claim()
+            except Exception as e:
+                logger.error(f"Ошибка выборки документов для архива: {e}")
+                claimed = []
+            # Очередь ограничена: пока воркеры заняты, новые документы не выбираются
+            for document in claimed:
+                await self._queue.put(document)
+            if len(claimed) < ARCHIVE_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), ARCHIVE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _claim(self) -> list:
+        now = time.time()
+        async with db.write('archive_claim') as conn:
+            cursor = await conn.execute(
+                """UPDATE documents SET archive_attempts = archive_attempts + 1, archive_after = ?
+                   WHERE id IN (
+                       SELECT id FROM documents
+                       WHERE storage_key IS NULL AND archive_after <= ? AND archive_attempts < ?
+                       ORDER BY archive_after, id LIMIT ?
+                   )
+                   RETURNING id, file_id, archive_attempts""",
+                (now + ARCHIVE_LEASE, now, ARCHIVE_MAX_ATTEMPTS, ARCHIVE_BATCH_SIZE)
+            )
+            return [dict(row) for row in await cursor.fetchall()]
+
+    async def _worker(self):
+        while True:
+            document = await self._queue.get()
+            try:
+                storage_key = await self._download(document['file_id'])
+            except Exception as e:
+                logger.warning(f"Документ {document['id']} не скачан в архив "
+                               f"(попытка {document['archive_attempts']}): {e}")
+                ARCHIVED_DOCUMENTS.labels('failed').inc()
+                retry_at = time.time() + ARCHIVE_RETRY_DELAY * 2 ** (document['archive_attempts'] - 1)
+                await self._finish(document['id'], None, retry_at)
+            else:
+                ARCHIVED_DOCUMENTS.labels('ok').inc()
+                await self._finish(document['id'], storage_key, 0)
+            finally:
+                self._queue.task_done()
+
+    async def _download(self, file_id: str) -> str:
+        file = await resolve_file(file_id)
+        file_url = bot.session.api.file_url(bot.token, file.file_path)
+        temp_path = self.store.temp_path()
+        digest = hashlib.sha256()
+        try:
+            async with get_http_session().get(file_url) as resp:
                 if resp.status != 200:
-                    raise HTTPException(status_code=resp.status, detail="Не удалось загрузить файл")
+                    raise RuntimeError(f"Telegram вернул HTTP {resp.status}")
+                async with aiofiles.open(temp_path, 'wb') as out:
+                    async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        digest.update(chunk)
+                        await out.write(chunk)
+            storage_key = digest.hexdigest()
+            self.store.put(temp_path, storage_key)
+            return storage_key
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    async def _finish(self, document_id: int, storage_key: Optional[str], archive_after: float):
+        try:
+            async with db.write('archive_finish') as conn:
+                await conn.execute(
+                    "UPDATE documents SET storage_key = ?, archive_after = ? WHERE id = ?",
+                    (storage_key, archive_after, document_id)
+                )
+        except Exception as e:
+            logger.error(f"Не удалось отметить документ {document_id} в архиве: {e}")
+
+    async def requeue(self, storage_key: str):
+        # Файл пропал из хранилища (например, каталог не пережил редеплой): документы скачиваются заново
+        async with db.write('archive_requeue') as conn:
+            cursor = await conn.execute(
+                "UPDATE documents SET storage_key = NULL, archive_after = 0, archive_attempts = 0 WHERE storage_key = ?",
+                (storage_key,)
+            )
+        logger.warning(f"Файл {storage_key} отсутствует в хранилище, документов в очереди: {cursor.rowcount}")
+        self.wake()
+
+archiver = DocumentArchiver(content_store)
+
+# file_id -> (ключ в хранилище, имя файла): ключ содержимого не меняется
+stored_files: OrderedDict = OrderedDict()
+
+async def find_stored_file(file_id: str) -> Optional[Tuple[str, str]]:
+    stored = stored_files.get(file_id)
+    if stored:
+        return stored
+    async with db.read('stored_file') as conn:
+        rows = await conn.execute_fetchall(
+            "SELECT storage_key, file_name FROM documents WHERE file_id = ? AND storage_key IS NOT NULL LIMIT 1",
+            (file_id,)
+        )
+    if not rows:
+        return None
+    stored = (rows[0]['storage_key'], rows[0]['file_name'])
+    remember(stored_files, file_id, stored)
+    return stored
+
+def content_disposition(filename: str) -> str:
+    # Имена файлов бывают кириллическими, а заголовки кодируются в latin-1
+    return f"attachment; filename*=UTF-8''{quote(filename)}"
+
+@app.get("/download/{file_id}")
+async def download_file(file_id: str, request: Request):
+    range_header = request.headers.get("range")
+    try:
+        # Архивная копия отдается с диска и не зависит от доступности файла в Telegram
+        stored = await find_stored_file(file_id)
+        stored_path = content_store.path(stored[0]) if stored else None
+        if stored and stored_path is None:
+            stored_files.pop(file_id, None)
+            await archiver.requeue(stored[0])
+        if stored_path:
+            headers = {"Content-Disposition": content_disposition(stored[1]), "Accept-Ranges": "bytes"}
+            if STORAGE_ACCEL_PREFIX:
+                accel_path = f"{STORAGE_ACCEL_PREFIX.rstrip('/')}/{content_store.relative_path(stored[0])}"
+                return Response(headers={**headers, "X-Accel-Redirect": accel_path})
+            return serve_local_file(stored_path, range_header, headers)
+
+        # Повторное скачивание уже закэшированного файла не обращается к Telegram
+        known = known_files.get(file_id)
+        cached_path = file_cache.get(known[0]) if known else None
+
+        file = None
+        if cached_path is None:
+            file = await resolve_file(file_id)
+            known = known_files[file_id]
+            cached_path = file_cache.get(known[0])
+
+        filename = known[1]
+        headers = {
+            "Content-Disposition": content_disposition(filename),
+            "Accept-Ranges": "bytes"
+        }
 
-                filename = file_path.split("/")[-1]
-                content = await resp.read()
-                return StreamingResponse(BytesIO(content), media_type="application/octet-stream", headers={
-                    "Content-Disposition": f"attachment; filename={filename}"
-                })
+        if cached_path:
+            return serve_local_file(cached_path, range_header, headers)
+        return await proxy_telegram_file(file, range_header, headers)
 
+    except HTTPException:
+        raise
+    except TelegramBadRequest as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка при скачивании файла: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def rebuild_stats_command():
+    await db.open()
+    try:
+        async with startup_lock():
+            await init_db()
+        print(json.dumps(await rebuild_stats(), ensure_ascii=False))
+    finally:
+        await db.close()
+
 if __name__ == "__main__":
+    # python legalbot.py rebuild-stats — пересчитать счетчики статистики и выйти
+    if sys.argv[1:] == ['rebuild-stats']:
+        asyncio.run(rebuild_stats_command())
+        sys.exit(0)
+    import uvicorn
     uvicorn.run(
         "legalbot:app",
         host="0.0.0.0",
-        port=8080,
-        reload=True
+        port=PORT,
+        workers=WEB_CONCURRENCY,
+        reload=os.getenv('UVICORN_RELOAD') == '1'
     )